@@ -0,0 +1,284 @@
+"""Exécution de lots de requêtes en ligne de commande.
+
+Au lieu d'écrire une boucle sur c.get() / c.post() dans un notebook, on
+décrit les requêtes dans un fichier JSONL (une requête JSON par ligne) :
+
+    {"method": "GET", "url": "/bin/police_hq/ticket/1496"}
+    {"method": "POST", "url": "/bin/echo", "args": {"toto": 42}, "id": "echo-1"}
+    {"method": "PUT", "url": "/home/michael60/AC", "content": "...", "account": "michael60"}
+
+puis on lance :
+
+    python -m client batch --mode stp --account login:motdepasse \\
+        --input requetes.jsonl --output resultats.jsonl --concurrency 8
+
+Chaque compte ne s'authentifie qu'une fois (au premier besoin), les
+requêtes sont exécutées par un pool de threads, et les résultats sont écrits
+en JSONL au fur et à mesure qu'ils arrivent (donc pas forcément dans
+l'ordre : le champ "index" donne le numéro de ligne de la requête). Un
+résumé (débit, latences) est affiché à la fin sur la sortie d'erreur.
+"""
+import argparse
+import base64
+import contextlib
+import json
+import sys
+import threading
+import time
+import concurrent.futures
+
+import client
+import controle
+
+
+MODES = ('chap', 'stp', 'dh', 'anonyme')
+
+# redirect_stdout() remplace sys.stdout pour tout le processus : les
+# authentifications (et donc les redirections) se font une par une
+_VERROU_SORTIE = threading.Lock()
+
+
+############################################################################
+#                          MÉTHODES PUBLIQUES                              #
+############################################################################
+
+class Comptes:
+    """
+    Connexions authentifiées, une par compte, ouvertes au premier besoin et
+    partagées par tous les threads.
+    """
+    def __init__(self, mode, identifiants, base_url, **options):
+        self.mode = mode
+        self.base_url = base_url
+        # options des connexions : deadline, connect_timeout... (cf. Connection)
+        self.options = options
+        # identifiants : liste de couples (login, mot de passe) ; le premier
+        # compte sert aux requêtes qui n'en précisent pas
+        self._mots_de_passe = dict(identifiants)
+        self._defaut = identifiants[0][0] if identifiants else None
+        self._connexions = {}
+        self._verrous = {login: threading.Lock() for login in self._mots_de_passe}
+        self._verrou_anonyme = threading.Lock()
+
+    def connexion(self, login=None):
+        login = login or self._defaut
+        if self.mode == 'anonyme' or login is None:
+            with self._verrou_anonyme:
+                if None not in self._connexions:
+                    self._connexions[None] = client.Connection(self.base_url, **self.options)
+            return self._connexions[None]
+        if login not in self._mots_de_passe:
+            raise KeyError("compte inconnu : {}".format(login))
+        with self._verrous[login]:
+            if login not in self._connexions:
+                # connexion2 affiche des messages pendant l'authentification :
+                # on les envoie sur stderr pour ne pas polluer la sortie JSONL
+                with _VERROU_SORTIE, contextlib.redirect_stdout(sys.stderr):
+                    self._connexions[login] = client.connexion2(
+                        self.mode, login, self._mots_de_passe[login], self.base_url, **self.options)
+        return self._connexions[login]
+
+
+def executer_requete(comptes, requete):
+    """Exécute une requête décrite par un dictionnaire et renvoie le résultat."""
+    methode = requete.get('method', 'GET').upper()
+    url = requete['url']
+    c = comptes.connexion(requete.get('account'))
+    if methode == 'GET':
+        return c.get(url)
+    if methode == 'POST':
+        return c.post(url, **requete.get('args', {}))
+    if methode == 'PUT':
+        return c.put(url, requete.get('content', ''))
+    raise ValueError("méthode inconnue : {}".format(methode))
+
+
+def executer_lot(comptes, lignes, sortie, concurrence=4):
+    """
+    Exécute les requêtes JSONL lues dans lignes (un itérable de str) avec
+    concurrence threads, et écrit un résultat JSON par ligne dans sortie dès
+    qu'il est disponible. Renvoie les statistiques du lot (cf. _resume()).
+
+    Les lignes sont lues au fur et à mesure : au plus 2 * concurrence
+    requêtes sont en mémoire à un instant donné.
+    """
+    verrou = threading.Lock()
+    places = threading.BoundedSemaphore(2 * concurrence)
+    latences = []
+    erreurs = [0]
+    invalides = [0]
+
+    def ecrire(enregistrement):
+        ligne = json.dumps(enregistrement, default=_json_default, ensure_ascii=False)
+        with verrou:
+            sortie.write(ligne + '\n')
+            sortie.flush()
+
+    def traiter(index, requete):
+        debut = time.perf_counter()
+        enregistrement = {'index': index}
+        if 'id' in requete:
+            enregistrement['id'] = requete['id']
+        enregistrement['method'] = requete.get('method', 'GET').upper()
+        enregistrement['url'] = requete.get('url')
+        try:
+            enregistrement['result'] = executer_requete(comptes, requete)
+            enregistrement['status'] = 'ok'
+        except client.ServerError as e:
+            enregistrement['status'] = 'error'
+            enregistrement['code'] = e.code
+            enregistrement['error'] = e.msg
+        except Exception as e:
+            enregistrement['status'] = 'error'
+            enregistrement['error'] = '{}: {}'.format(type(e).__name__, e)
+        latence = time.perf_counter() - debut
+        enregistrement['latency'] = round(latence, 6)
+        with verrou:
+            latences.append(latence)
+            if enregistrement['status'] != 'ok':
+                erreurs[0] += 1
+        ecrire(enregistrement)
+
+    debut = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrence) as pool:
+        for index, ligne in enumerate(lignes):
+            ligne = ligne.strip()
+            if not ligne:
+                continue
+            try:
+                requete = json.loads(ligne)
+                if not isinstance(requete, dict) or 'url' not in requete:
+                    raise ValueError("champ 'url' manquant")
+            except ValueError as e:
+                # requête jamais envoyée : comptée comme erreur, mais pas
+                # dans les latences
+                with verrou:
+                    erreurs[0] += 1
+                    invalides[0] += 1
+                ecrire({'index': index, 'status': 'error', 'error': 'requête invalide : {}'.format(e)})
+                continue
+            places.acquire()
+            futur = pool.submit(traiter, index, requete)
+            futur.add_done_callback(lambda f: places.release())
+    return _resume(latences, erreurs[0], invalides[0], time.perf_counter() - debut)
+
+
+def main(argv=None):
+    """Point d'entrée de « python -m client batch »."""
+    parser = argparse.ArgumentParser(prog='python -m client')
+    commandes = parser.add_subparsers(dest='commande')
+    lot = commandes.add_parser('batch', help='exécute un lot de requêtes JSONL')
+    lot.add_argument('--input', '-i', default='-',
+                     help='fichier JSONL des requêtes (défaut : entrée standard)')
+    lot.add_argument('--output', '-o', default='-',
+                     help='fichier JSONL des résultats (défaut : sortie standard)')
+    lot.add_argument('--mode', '-m', choices=MODES, default='chap',
+                     help="mode d'authentification (défaut : chap)")
+    lot.add_argument('--account', '-a', action='append', default=[], metavar='LOGIN:MOT_DE_PASSE',
+                     help='compte à utiliser (répétable ; le premier est le compte par défaut)')
+    lot.add_argument('--accounts', metavar='FICHIER',
+                     help='fichier JSON {"login": "mot de passe", ...}')
+    lot.add_argument('--concurrency', '-c', type=int, default=4,
+                     help='nombre de requêtes simultanées (défaut : 4)')
+    lot.add_argument('--base-url', default='http://isec.fil.cool/uglix')
+    lot.add_argument('--deadline', type=float, metavar='SECONDES',
+                     help='durée maximale de chaque requête, chiffrement compris')
+    lot.add_argument('--connect-timeout', type=float, metavar='SECONDES')
+    lot.add_argument('--read-timeout', type=float, metavar='SECONDES')
+    lot.add_argument('--hedge-percentile', type=float, metavar='Q',
+                     help='renvoie une copie des GET plus lents que ce centile (ex. 0.95)')
+    lot.add_argument('--adaptive', action='store_true',
+                     help='adapte le nombre de requêtes en vol (au plus --concurrency) aux 429/503 et à la latence')
+    lot.add_argument('--rate', type=float, metavar='REQ/S',
+                     help='débit maximal par point d\'accès (implique --adaptive)')
+    lot.add_argument('--coalesce', action='store_true',
+                     help='regroupe les GET identiques simultanés en une seule requête')
+    args = parser.parse_args(argv)
+    if args.commande != 'batch':
+        parser.print_help(sys.stderr)
+        return 2
+    if args.concurrency < 1:
+        parser.error('--concurrency doit être au moins 1')
+
+    identifiants = []
+    for compte in args.account:
+        if ':' not in compte:
+            parser.error('--account attend LOGIN:MOT_DE_PASSE')
+        identifiants.append(tuple(compte.split(':', 1)))
+    if args.accounts:
+        with open(args.accounts) as f:
+            identifiants.extend(json.load(f).items())
+    if args.mode != 'anonyme' and not identifiants:
+        parser.error('il faut au moins un compte (--account ou --accounts) en mode {}'.format(args.mode))
+
+    controleur = None
+    if args.adaptive or args.rate is not None:
+        # un seul contrôleur pour tous les comptes : c'est le même serveur
+        controleur = controle.ControleurDebit(debit=args.rate, limite_initiale=args.concurrency,
+                                              limite_max=args.concurrency)
+    comptes = Comptes(args.mode, identifiants, args.base_url, deadline=args.deadline,
+                      connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+                      hedge_percentile=args.hedge_percentile, coalesce=args.coalesce,
+                      controleur=controleur)
+    with _ouvrir(args.input, sys.stdin, 'r') as entree, _ouvrir(args.output, sys.stdout, 'w') as sortie:
+        stats = executer_lot(comptes, entree, sortie, args.concurrency)
+    _afficher_resume(stats, sys.stderr)
+    if controleur is not None:
+        sys.stderr.write('contrôle du débit : {}\n'.format(controleur.statistiques()))
+    return 0 if stats['errors'] == 0 else 1
+
+
+############################################################################
+#                          MÉTHODES INTERNES                               #
+############################################################################
+
+def _json_default(objet):
+    # les contenus binaires sont transmis en base64
+    if isinstance(objet, (bytes, bytearray, memoryview)):
+        return {'base64': base64.b64encode(objet).decode()}
+    if isinstance(objet, client.ContenuDiffere):
+        return objet.valeur
+    raise TypeError('{} non sérialisable en JSON'.format(type(objet).__name__))
+
+
+def _ouvrir(nom, standard, mode):
+    if nom == '-':
+        return contextlib.nullcontext(standard)
+    return open(nom, mode, encoding='utf-8')
+
+
+def _centile(valeurs_triees, q):
+    if not valeurs_triees:
+        return 0.0
+    rang = min(len(valeurs_triees) - 1, int(round(q * (len(valeurs_triees) - 1))))
+    return valeurs_triees[rang]
+
+
+def _resume(latences, erreurs, invalides, duree):
+    # les latences (et le débit) ne portent que sur les requêtes envoyées ;
+    # les lignes invalides ne comptent que parmi les erreurs
+    latences = sorted(latences)
+    return {
+        'requests': len(latences) + invalides,
+        'errors': erreurs,
+        'invalid': invalides,
+        'duration': duree,
+        'throughput': len(latences) / duree if duree > 0 else 0.0,
+        'p50': _centile(latences, 0.50),
+        'p90': _centile(latences, 0.90),
+        'p99': _centile(latences, 0.99),
+        'max': latences[-1] if latences else 0.0,
+    }
+
+
+def _afficher_resume(stats, fichier):
+    fichier.write(
+        "{requests} requêtes ({errors} erreurs, dont {invalid} lignes invalides) en {duration:.2f} s, "
+        "{throughput:.1f} req/s\n"
+        "latence : p50 {p50_ms:.1f} ms, p90 {p90_ms:.1f} ms, p99 {p99_ms:.1f} ms, max {max_ms:.1f} ms\n".format(
+            p50_ms=stats['p50'] * 1e3, p90_ms=stats['p90'] * 1e3,
+            p99_ms=stats['p99'] * 1e3, max_ms=stats['max'] * 1e3, **stats))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
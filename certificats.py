@@ -0,0 +1,265 @@
+"""Magasin de certificats et de clefs publiques.
+
+À chaque connexion DH, connexion2 retéléchargeait /bin/banks/CA puis
+lançait recuperer_cle_public() (un « openssl x509 -pubkey ») pour en
+extraire toujours la même clef. Les certificats stockés dans des fichiers
+(bank_certificat.pem, certificats*.txt) subissaient le même sort.
+
+Le magasin télécharge chaque certificat une seule fois, l'analyse avec un
+seul appel à openssl, et garde le résultat (certificat, clef publique,
+sujet, empreinte SHA-256, période de validité) en mémoire. Sur disque, il
+ne garde que le certificat lui-même : le reste en est redérivé à la
+lecture, pour qu'un fichier de cache modifié ne puisse pas substituer une
+autre clef publique.
+Un certificat n'est retéléchargé que lorsqu'il sort de sa période de
+validité, et un fichier n'est relu que s'il a été modifié ; il n'est
+réanalysé que si son empreinte a changé.
+
+    >>> ca = magasin.depuis_url(c, '/bin/banks/CA')
+    >>> verification_signature_carte(ca.cle_publique, signature, S)
+    >>> magasin.depuis_fichier('bank_certificat.pem').sujet
+    'O = Torres LLC, OU = Key Management, CN = Bank CA'
+"""
+import base64
+import collections
+import hashlib
+import json
+import os
+import ssl
+import subprocess
+import threading
+import time
+
+from openssl import OpensslError
+
+
+# répertoire par défaut du cache disque
+REPERTOIRE = os.environ.get('UGLIX_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'uglix', 'certificats'))
+
+# un certificat hors de sa période de validité n'est pas retéléchargé plus
+# d'une fois par RETENTATIVE secondes (le serveur peut très bien continuer à
+# renvoyer un certificat expiré)
+RETENTATIVE = 300
+
+
+class Certificat(collections.namedtuple('Certificat', ['pem', 'cle_publique', 'sujet', 'empreinte', 'debut', 'fin'])):
+    """
+    Certificat analysé. debut et fin sont des dates en secondes depuis
+    l'epoch ; empreinte est le SHA-256 (hexadécimal) du certificat DER.
+    """
+    __slots__ = ()
+
+    def valide(self, maintenant=None):
+        """Indique si le certificat est dans sa période de validité."""
+        if maintenant is None:
+            maintenant = time.time()
+        return self.debut <= maintenant <= self.fin
+
+
+def empreinte_pem(pem):
+    """Renvoie l'empreinte SHA-256 (hexadécimale) d'un certificat PEM, sans openssl."""
+    if isinstance(pem, bytes):
+        pem = pem.decode()
+    lignes = [l.strip() for l in pem.strip().splitlines()]
+    try:
+        debut = lignes.index('-----BEGIN CERTIFICATE-----')
+        fin = lignes.index('-----END CERTIFICATE-----', debut)
+    except ValueError:
+        raise OpensslError('pas de certificat PEM') from None
+    return hashlib.sha256(base64.b64decode(''.join(lignes[debut + 1:fin]))).hexdigest()
+
+
+def analyser_certificat(pem):
+    """
+    Analyse un certificat PEM avec un seul appel à openssl et renvoie un
+    Certificat.
+    """
+    if isinstance(pem, bytes):
+        pem = pem.decode()
+    args = ['openssl', 'x509', '-noout', '-pubkey', '-subject', '-startdate', '-enddate']
+    result = subprocess.run(args, input=pem.encode(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    # si un message d'erreur est présent sur stderr, on arrête tout
+    error_message = result.stderr.decode()
+    if result.returncode != 0 or error_message != '':
+        raise OpensslError(error_message)
+
+    sortie = result.stdout.decode()
+    fin_cle = sortie.index('-----END PUBLIC KEY-----') + len('-----END PUBLIC KEY-----')
+    cle_publique = sortie[sortie.index('-----BEGIN PUBLIC KEY-----'):fin_cle] + '\n'
+    champs = {}
+    for ligne in sortie[fin_cle:].splitlines():
+        if '=' in ligne:
+            clef, valeur = ligne.split('=', 1)
+            champs[clef.strip()] = valeur.strip()
+    return Certificat(pem=pem,
+                      cle_publique=cle_publique,
+                      sujet=champs.get('subject', ''),
+                      empreinte=empreinte_pem(pem),
+                      debut=ssl.cert_time_to_seconds(champs['notBefore']),
+                      fin=ssl.cert_time_to_seconds(champs['notAfter']))
+
+
+class MagasinCertificats:
+    """
+    Cache de certificats, en mémoire et (si repertoire n'est pas None) sur
+    disque, indexé par la source du certificat (URL ou chemin de fichier).
+    Utilisable depuis plusieurs threads.
+    """
+    def __init__(self, repertoire=REPERTOIRE):
+        self.repertoire = repertoire
+        self._entrees = {}      # source -> (certificat, date du dernier téléchargement)
+        self._fichiers = {}     # chemin -> (mtime, taille)
+        self._analyses = {}     # empreinte -> Certificat (pour ne jamais réanalyser)
+        # empreintes successives de chaque source : un changement d'empreinte
+        # signale un certificat renouvelé (ou remplacé...)
+        self.historique = collections.defaultdict(list)
+        self.statistiques = collections.Counter()
+        self._verrou = threading.RLock()
+
+    ############################################################################
+    #                          MÉTHODES PUBLIQUES                              #
+    ############################################################################
+
+    def obtenir(self, source, charger):
+        """
+        Renvoie le Certificat associé à source. charger() n'est appelée (pour
+        télécharger le PEM) que si le certificat n'est ni en mémoire ni sur
+        disque, ou s'il est sorti de sa période de validité.
+        """
+        with self._verrou:
+            entree = self._entrees.get(source)
+            if entree is None:
+                entree = self._lire_disque(source)
+            if entree is not None:
+                certificat, telechargement = entree
+                if certificat.valide() or time.time() - telechargement < RETENTATIVE:
+                    self.statistiques['hits'] += 1
+                    return certificat
+                self.statistiques['expired'] += 1
+            self.statistiques['fetches'] += 1
+            return self._enregistrer(source, charger())
+
+    def depuis_url(self, connexion, url):
+        """
+        Renvoie le certificat publié à l'url donnée (par exemple
+        '/bin/banks/CA'), téléchargé par une requête GET en clair.
+        """
+        from client import Connection, ContenuDiffere
+
+        def charger():
+            pem = Connection.get(connexion, url)
+            # connexion ouverte avec decodage_differe=True
+            if isinstance(pem, ContenuDiffere):
+                pem = pem.valeur
+            return pem
+
+        source = connexion._base + url
+        return self.obtenir(source, charger)
+
+    def depuis_fichier(self, chemin):
+        """
+        Renvoie le certificat contenu dans un fichier. Le fichier n'est relu
+        que si sa date de modification ou sa taille a changé.
+        """
+        chemin = os.path.abspath(chemin)
+        etat = os.stat(chemin)
+        signature = (etat.st_mtime_ns, etat.st_size)
+        with self._verrou:
+            if self._fichiers.get(chemin) == signature and chemin in self._entrees:
+                self.statistiques['hits'] += 1
+                return self._entrees[chemin][0]
+            with open(chemin) as f:
+                pem = f.read()
+            self._fichiers[chemin] = signature
+            self.statistiques['reads'] += 1
+            return self._enregistrer(chemin, pem)
+
+    def par_empreinte(self, empreinte):
+        """Renvoie le certificat d'empreinte donnée s'il est connu, None sinon."""
+        with self._verrou:
+            return self._analyses.get(empreinte.replace(':', '').lower())
+
+    def oublier(self, source=None):
+        """Oublie une source (ou toutes), en mémoire et sur disque."""
+        with self._verrou:
+            sources = list(self._entrees) if source is None else [source]
+            for s in sources:
+                self._entrees.pop(s, None)
+                self._fichiers.pop(s, None)
+                if self.repertoire is not None:
+                    try:
+                        os.remove(self._fichier_cache(s))
+                    except FileNotFoundError:
+                        pass
+
+    ############################################################################
+    #                          MÉTHODES INTERNES                               #
+    ############################################################################
+
+    def _enregistrer(self, source, pem):
+        empreinte = empreinte_pem(pem)
+        certificat = self._analyses.get(empreinte)
+        if certificat is None:
+            # seul un certificat jamais vu est analysé par openssl
+            certificat = analyser_certificat(pem)
+            self._analyses[empreinte] = certificat
+            self.statistiques['parses'] += 1
+        if not self.historique[source] or self.historique[source][-1] != empreinte:
+            self.historique[source].append(empreinte)
+        entree = (certificat, time.time())
+        self._entrees[source] = entree
+        self._ecrire_disque(source, entree)
+        return certificat
+
+    def _fichier_cache(self, source):
+        return os.path.join(self.repertoire, hashlib.sha256(source.encode()).hexdigest() + '.json')
+
+    def _lire_disque(self, source):
+        if self.repertoire is None:
+            return None
+        try:
+            with open(self._fichier_cache(source)) as f:
+                donnees = json.load(f)
+            pem = donnees['pem']
+            telechargement = float(donnees.get('telechargement', 0))
+            empreinte = empreinte_pem(pem)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, OpensslError):
+            return None
+        # seul le PEM est lu sur disque : clef publique, sujet et période de
+        # validité en sont toujours redérivés (une seule fois par empreinte),
+        # jamais lus tels quels dans un fichier qui a pu être modifié
+        certificat = self._analyses.get(empreinte)
+        if certificat is None:
+            try:
+                certificat = analyser_certificat(pem)
+            except (OpensslError, ValueError, KeyError):
+                return None
+            self._analyses[empreinte] = certificat
+            self.statistiques['parses'] += 1
+        if not self.historique[source] or self.historique[source][-1] != empreinte:
+            self.historique[source].append(empreinte)
+        entree = (certificat, telechargement)
+        self._entrees[source] = entree
+        self.statistiques['disk_hits'] += 1
+        return entree
+
+    def _ecrire_disque(self, source, entree):
+        if self.repertoire is None:
+            return
+        certificat, telechargement = entree
+        donnees = {'source': source, 'telechargement': telechargement, 'pem': certificat.pem}
+        nom = self._fichier_cache(source)
+        try:
+            os.makedirs(self.repertoire, exist_ok=True)
+            temporaire = '{}.{}.tmp'.format(nom, threading.get_ident())
+            with open(temporaire, 'w') as f:
+                json.dump(donnees, f)
+            os.replace(temporaire, nom)
+        except OSError:
+            # le cache disque n'est qu'une optimisation
+            pass
+
+
+# magasin partagé par défaut
+magasin = MagasinCertificats()
@@ -14,15 +14,34 @@
     INFECT IT WITH A VERY NASTY VIRUS or even RUN ARBITRARY CODE on it. 
     See the UGL (Uglix Public License) for more legal and technical details.
 """
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import functools
+import http.client
 import json
+import pickle
+import re
+import socket
+import subprocess
+import threading
 import urllib.request
 import urllib.parse
 import urllib.error
 from openssl import *
+from certificats import magasin as magasin_certificats
+from controle import CODES_SURCHARGE, lire_retry_after
+import synchronisation
 from random import randint 
 from hashlib import sha256
 import time
+try:
+    # backend JSON optionnel, nettement plus rapide que le module standard
+    import orjson
+except ImportError:
+    orjson = None
 # Ceci est du code Python v3.4+ (une version >= 3.4 est requise pour une
 # compatibilité optimale).
 
@@ -33,13 +52,251 @@ class ServerError(Exception):
     Exception déclenchée en cas de problème côté serveur (URL incorrecte,
     accès interdit, requête mal formée, etc.)
     """
-    def __init__(self, code=None, msg=None):
+    def __init__(self, code=None, msg=None, headers=None):
         self.code = code
         self.msg = msg
+        self.headers = headers or {}    # en-têtes HTTP de la réponse
 
     def __str__(self):
         return "ERREUR {}, {}".format(self.code, self.msg)
 
+
+class DeadlineExceeded(ServerError):
+    """
+    Exception déclenchée quand une requête n'a pas abouti dans les temps
+    (échéance dépassée, délai de connexion ou de lecture écoulé). C'est une
+    ServerError : les boucles qui rattrapent ServerError la gèrent aussi.
+    """
+    def __init__(self, msg=None):
+        super().__init__(None, msg)
+
+    def __str__(self):
+        return "DÉLAI DÉPASSÉ, {}".format(self.msg)
+
+
+################################################################################
+#                          DÉCODAGE DES RÉPONSES                               #
+################################################################################
+
+# Registre des décodeurs, indexé par type de contenu ('application/json') ou
+# par famille de types ('text/*'). Un décodeur reçoit le corps brut (bytes)
+# et le dictionnaire des paramètres du Content-Type (charset, etc.).
+_CODECS = {}
+
+
+def enregistrer_codec(content_type, decodeur):
+    """
+    Associe un décodeur à un type de contenu. Les réponses de ce type seront
+    passées à decodeur(corps, parametres), où corps est un bytes() et
+    parametres un dictionnaire (par exemple {'charset': 'utf-8'}). On peut
+    donner un type précis ('image/png') ou une famille ('image/*').
+
+    >>> enregistrer_codec('application/octet-stream', lambda corps, parametres: memoryview(corps))
+    """
+    _CODECS[content_type.lower()] = decodeur
+
+
+def decoder_contenu(contenu, content_type):
+    """
+    Décode le corps brut d'une réponse selon son type de contenu, à l'aide
+    du registre des codecs. Si aucun décodeur ne correspond, on renvoie le
+    corps tel quel.
+    """
+    if not content_type:
+        return contenu
+    morceaux = content_type.split(';')
+    type_principal = morceaux[0].strip().lower()
+    parametres = {}
+    for morceau in morceaux[1:]:
+        if '=' in morceau:
+            clef, valeur = morceau.split('=', 1)
+            parametres[clef.strip().lower()] = valeur.strip().strip('"')
+    decodeur = _CODECS.get(type_principal)
+    if decodeur is None:
+        decodeur = _CODECS.get(type_principal.split('/')[0] + '/*')
+    if decodeur is None:
+        return contenu
+    return decodeur(contenu, parametres)
+
+
+# on ne reconnaît un JSON dans une réponse sans type de contenu (celles de la
+# passerelle, par exemple) qu'à son premier caractère
+_DEBUT_JSON = re.compile(rb'\s*[\[{]')
+
+
+def deviner_content_type(contenu):
+    """
+    Devine le type d'un contenu qui n'en annonce pas : JSON s'il en a l'air
+    et qu'il se décode, texte s'il s'agit d'UTF-8 valide, binaire
+    ('application/octet-stream', laissé tel quel par défaut) sinon.
+    """
+    return _deviner(contenu)[0]
+
+
+# valeur d'un contenu pas encore décodé
+_NON_DECODE = object()
+
+
+def _deviner(contenu):
+    """
+    Comme deviner_content_type(), mais renvoie aussi la valeur décodée
+    pendant la détection (ou _NON_DECODE), pour ne pas décoder deux fois le
+    même contenu. La valeur n'est gardée que si le décodeur enregistré pour
+    ce type est celui qui a servi à la détection.
+    """
+    if isinstance(contenu, str):
+        contenu = contenu.encode()
+    if _DEBUT_JSON.match(contenu):
+        try:
+            valeur = _decoder_json(contenu, {})
+        except ValueError:
+            pass
+        else:
+            if _CODECS.get('application/json') is not _decoder_json:
+                valeur = _NON_DECODE
+            return 'application/json', valeur
+    if b'\x00' in contenu:
+        return 'application/octet-stream', _NON_DECODE
+    try:
+        valeur = codecs.decode(contenu, 'utf-8')
+    except UnicodeDecodeError:
+        return 'application/octet-stream', _NON_DECODE
+    if _CODECS.get('text/plain', _CODECS.get('text/*')) is not _decoder_texte:
+        valeur = _NON_DECODE
+    return 'text/plain; charset=utf-8', valeur
+
+
+# orjson ne sait pas représenter exactement les entiers de plus de 64 bits
+# (il les refuse, ou les convertit en float) : un JSON contenant une suite
+# d'au moins 19 chiffres (les paramètres DH, RSA, ElGamal...) est confié au
+# module standard
+_GRAND_ENTIER = re.compile(rb'\d{19}')
+
+
+def _decoder_json(contenu, parametres):
+    # json.loads() accepte directement des bytes(), pas besoin de decode()
+    if orjson is not None and not _GRAND_ENTIER.search(contenu):
+        return orjson.loads(contenu)
+    return json.loads(contenu)
+
+
+def _decoder_texte(contenu, parametres):
+    # str() accepte aussi les memoryview (qui n'ont pas de decode())
+    return str(contenu, parametres.get('charset', 'utf-8'))
+
+
+enregistrer_codec('application/json', _decoder_json)
+enregistrer_codec('text/*', _decoder_texte)
+
+
+class ContenuDiffere:
+    """
+    Réponse dont le décodage est retardé jusqu'au premier accès à valeur.
+    Le corps brut reste disponible dans brut, ce qui permet de le stocker ou
+    de le transmettre sans jamais le décoder.
+    """
+    def __init__(self, brut, content_type, valeur=_NON_DECODE):
+        self.brut = brut
+        self.content_type = content_type
+        # valeur peut être déjà connue (décodée pendant la détection du type)
+        self._valeur = valeur
+
+    @property
+    def valeur(self):
+        if self._valeur is _NON_DECODE:
+            self._valeur = decoder_contenu(self.brut, self.content_type)
+        return self._valeur
+
+    def __repr__(self):
+        return 'ContenuDiffere({!r}, {} octets)'.format(self.content_type, len(self.brut))
+
+
+################################################################################
+#                          DÉLAIS DE CONNEXION ET DE LECTURE                   #
+################################################################################
+
+# urllib n'a qu'un seul délai, qui sert à la fois pour la connexion et pour
+# chaque lecture. Ces classes appliquent request.timeout à la connexion, puis
+# request.read_timeout aux lectures une fois la connexion établie.
+
+class _DelaiLecture:
+    def __init__(self, *args, read_timeout=None, **kwds):
+        super().__init__(*args, **kwds)
+        self._read_timeout = read_timeout
+
+    def connect(self):
+        super().connect()
+        # None : lectures bloquantes, comme urllib sans délai
+        self.sock.settimeout(self._read_timeout)
+
+
+class _ConnexionHTTP(_DelaiLecture, http.client.HTTPConnection):
+    pass
+
+
+class _ConnexionHTTPS(_DelaiLecture, http.client.HTTPSConnection):
+    pass
+
+
+class _HandlerHTTP(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        classe = functools.partial(_ConnexionHTTP, read_timeout=getattr(req, 'read_timeout', None))
+        return self.do_open(classe, req)
+
+
+class _HandlerHTTPS(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        classe = functools.partial(_ConnexionHTTPS, read_timeout=getattr(req, 'read_timeout', None))
+        return self.do_open(classe, req, context=self._context)
+
+
+_opener = urllib.request.build_opener(_HandlerHTTP, _HandlerHTTPS)
+
+
+class _Vol:
+    """Requête en cours, partagée par les appelants regroupés."""
+    def __init__(self, echeance):
+        self.fini = threading.Event()
+        self.resultat = None
+        self.erreur = None
+        self.echeance = echeance            # échéance du meneur
+        self.echeance_depassee = False      # le meneur a-t-il échoué faute de temps ?
+
+
+# résultats partagés tels quels entre appelants regroupés, sans copie
+_IMMUABLES = (bytes, str, memoryview, int, float, bool, type(None))
+
+
+def _copie(valeur):
+    """Copie indépendante d'un résultat partagé par des appelants regroupés."""
+    if isinstance(valeur, _IMMUABLES):
+        return valeur
+    if isinstance(valeur, ContenuDiffere):
+        decodee = valeur._valeur
+        if decodee is not _NON_DECODE:
+            decodee = _copie(decodee)
+        return ContenuDiffere(valeur.brut, valeur.content_type, decodee)
+    return copy.deepcopy(valeur)
+
+
+def _minimum(*valeurs):
+    valeurs = [v for v in valeurs if v is not None]
+    return min(valeurs) if valeurs else None
+
+
+def _entete(http_headers, nom):
+    # les noms des en-têtes HTTP ne sont pas sensibles à la casse
+    nom = nom.lower()
+    for clef, valeur in http_headers.items():
+        if clef.lower() == nom:
+            return valeur
+    return None
+
+
+def _content_type(http_headers):
+    return _entete(http_headers, 'Content-Type')
+
+
 class Connection:
     """
     Cette classe sert à ouvrir et à maintenir une connection avec le système
@@ -63,10 +320,76 @@ class Connection:
     >>> print(c.get('/'))   # doctest: +ELLIPSIS
     HAL HAL HAL HAL HAL HAL HAL HAL HAL HAL HAL HAL HAL HAL HAL HAL HAL HAL HAL HAL
     ...
+
+    Délais : deadline borne la durée totale de chaque appel à get(), post()...
+    (chiffrement compris, pour les sous-classes), connect_timeout celle de
+    l'établissement de la connexion et read_timeout celle de chaque lecture.
+    Un dépassement déclenche DeadlineExceeded. Pour un appel particulier,
+    on utilise delai() :
+
+    >>> c = Connection(connect_timeout=3, read_timeout=10)
+    >>> with c.delai(2.5):
+    ...     c.get('/bin/echo')
+
+    Requêtes couvertes : si hedge_percentile vaut par exemple 0.95, un GET
+    qui n'a pas répondu au bout de la latence du 95e centile des GET
+    précédents est envoyé une seconde fois, et on garde la première réponse.
+    La latence des appels n'est alors plus fixée par la réponse la plus lente
+    du serveur, au prix d'environ 5 % de requêtes en plus.
+
+    Regroupement : si coalesce est vrai, des GET identiques lancés en même
+    temps par plusieurs threads sur la même session ne partent qu'une fois ;
+    tous les appelants reçoivent le même résultat (ou la même exception).
+    statistiques()['coalesced'] compte les requêtes ainsi évitées.
+
+    Contrôle du débit : controleur est un ControleurDebit (cf. controle.py),
+    éventuellement partagé entre plusieurs connexions. Chaque requête attend
+    son autorisation, et une requête refusée pour surcharge (429, 503) est
+    renvoyée jusqu'à retries fois, après la pause demandée par Retry-After.
+
+    Une connexion peut être sérialisée avec pickle, par exemple pour être
+    envoyée à un autre processus (cf. repartir()) : elle y garde sa session,
+    mais pas son contrôleur de débit ni ses statistiques.
     """
-    def __init__(self, base_url="http://isec.fil.cool/uglix"):
+    # nombre minimal de latences mesurées avant d'envoyer des copies
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(self, base_url="http://isec.fil.cool/uglix", decodage_differe=False,
+                 deadline=None, connect_timeout=None, read_timeout=None, hedge_percentile=None,
+                 coalesce=False, controleur=None, retries=3):
         self._base = base_url
         self._session = None   # au départ nous n'avons pas de cookie de session
+        # si decodage_differe est vrai, get(), post()... renvoient des
+        # ContenuDiffere, décodés seulement au premier accès
+        self._decodage_differe = decodage_differe
+        self._deadline = deadline
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._hedge_percentile = hedge_percentile
+        self._coalesce = coalesce
+        self._retries = retries
+        self._etat_local()
+        self._controleur = controleur
+
+    # attributs propres au processus : ils ne sont pas transmis quand la
+    # connexion est sérialisée (pickle), mais recréés vides à l'arrivée
+    _ATTRIBUTS_LOCAUX = ('_local', '_verrou', '_latences', '_pool_copies', '_en_vol', '_controleur', '_stats')
+
+    def __getstate__(self):
+        """
+        Une connexion sérialisée (pickle) se réduit à une poignée légère :
+        adresse de base, cookie de session et options. Verrous, pool de
+        threads, statistiques et contrôleur de débit restent dans le
+        processus d'origine.
+        """
+        etat = dict(self.__dict__)
+        for nom in self._ATTRIBUTS_LOCAUX:
+            etat.pop(nom, None)
+        return etat
+
+    def __setstate__(self, etat):
+        self.__dict__.update(etat)
+        self._etat_local()
 
     ############################################################################
     #                          MÉTHODES PUBLIQUES                              #
@@ -85,9 +408,8 @@ class Connection:
         ...
         client.ServerError: ERREUR 404, ...
         """
-        # prépare la requête
-        request = urllib.request.Request(self._base + url, method='GET')
-        return self._query(url, request)
+        with self._operation():
+            return self._idempotent(self._get, url)
 
 
     def post(self, url, **kwds):
@@ -125,7 +447,8 @@ class Connection:
         if kwds:     
             request.add_header('Content-type', 'application/json')
             data = json.dumps(kwds).encode()
-        return self._query(url, request, data)
+        with self._operation():
+            return self._query(url, request, data)
 
 
     def put(self, url, content):
@@ -133,12 +456,14 @@ class Connection:
         Charge l'URL demandée avec une requête HTTP PUT. L'argument content
         forme le corps de la requête. Si content est de type str(), il est
         automatiquement encodé en UTF-8. cf /doc/strings pour plus de détails
-        sur la question.
+        sur la question. Les objets bytes-like (bytearray, memoryview) sont
+        envoyés tels quels, sans copie.
         """
         request = urllib.request.Request(self._base + url, method='PUT')
         if isinstance(content, str):
             content = content.encode()
-        return self._query(url, request, data=content)
+        with self._operation():
+            return self._query(url, request, data=content)
 
     ############################################################################
     #                     MÉTHODES PUBLIQUES AVANCÉES                          #
@@ -149,7 +474,8 @@ class Connection:
         """
         Charge l'url demandée avec une requête HTTP POST. L'argument data
         forme le corps de la requête. Il doit s'agir d'un objet de type 
-        bytes(). Cette méthode est d'un usage plus rare, et sert à envoyer des
+        bytes(), ou de tout objet bytes-like (bytearray, memoryview), envoyé
+        sans copie. Cette méthode est d'un usage plus rare, et sert à envoyer des
         données qui n'ont pas vocation à être serialisées en JSON (comme des
         données binaires chiffrées, par exemple).
 
@@ -158,7 +484,8 @@ class Connection:
         """
         request = urllib.request.Request(self._base + url, method='POST')
         request.add_header('Content-type', content_type)
-        return self._query(url, request, data)
+        with self._operation():
+            return self._query(url, request, data)
 
     def close_session(self):
         """
@@ -166,11 +493,42 @@ class Connection:
         """
         self._session = None
 
+    @contextlib.contextmanager
+    def delai(self, secondes):
+        """
+        Impose une échéance, dans secondes secondes, à toutes les requêtes
+        lancées par ce thread dans le bloc with. Les échéances imbriquées se
+        cumulent : c'est la plus proche qui compte.
+        """
+        precedente = getattr(self._local, 'echeance', None)
+        self._local.echeance = _minimum(time.monotonic() + secondes, precedente)
+        try:
+            yield
+        finally:
+            self._local.echeance = precedente
+
+    def statistiques(self):
+        """
+        Renvoie un dictionnaire de compteurs sur l'activité de la connexion
+        (copies de requêtes envoyées et gagnantes, délais dépassés...).
+        """
+        with self._verrou:
+            return dict(self._stats)
+
 
     ############################################################################
     #                          MÉTHODES INTERNES                               #
     ############################################################################
 
+    def _etat_local(self):
+        self._local = threading.local()     # échéance courante, par thread
+        self._verrou = threading.Lock()
+        self._latences = collections.deque(maxlen=256)
+        self._pool_copies = None
+        self._en_vol = {}       # requêtes en cours, pour le regroupement
+        self._controleur = None
+        self._stats = collections.Counter()
+
     def _pre_process(self, request):
         """
         Effectue un pré-traitement sur la requête pas encore lancée.
@@ -184,32 +542,235 @@ class Connection:
         """
         Effectue un post-traitement sur le résultat "brut" de la requête. En
         particulier, on décode les dictionnaires JSON, et on convertit le texte
-        (encodé en UTF-8) en chaine de charactère Unicode. On peut étendre cette
-        méthode pour gérer d'autres types de contenu si besoin.
+        (encodé en UTF-8) en chaine de charactère Unicode. Pour gérer d'autres
+        types de contenu, il suffit d'enregistrer un codec avec
+        enregistrer_codec(). Les types inconnus sont laissés tels quels.
+        """
+        return self._decoder(result, _content_type(http_headers))
+
+    def _decoder(self, result, content_type, valeur=_NON_DECODE):
+        """
+        Décode (ou prépare le décodage différé d') un résultat de type
+        content_type. valeur est le résultat déjà décodé, s'il est connu.
+        """
+        if self._decodage_differe:
+            return ContenuDiffere(result, content_type, valeur)
+        if valeur is not _NON_DECODE:
+            return valeur
+        return decoder_contenu(result, content_type)
+
+    def _get(self, url):
+        # prépare la requête
+        request = urllib.request.Request(self._base + url, method='GET')
+        return self._query(url, request)
+
+    @contextlib.contextmanager
+    def _operation(self):
+        """
+        Encadre un appel public : l'appel le plus externe fixe l'échéance par
+        défaut de la connexion, que les appels internes (passerelle,
+        connexion...) partagent.
+        """
+        if self._deadline is None or getattr(self._local, 'echeance', None) is not None:
+            yield
+        else:
+            with self.delai(self._deadline):
+                yield
+
+    def _restant(self):
+        """
+        Renvoie le temps restant avant l'échéance courante (None s'il n'y en a
+        pas), ou déclenche DeadlineExceeded si elle est passée.
+        """
+        echeance = getattr(self._local, 'echeance', None)
+        if echeance is None:
+            return None
+        restant = echeance - time.monotonic()
+        if restant <= 0:
+            with self._verrou:
+                self._stats['deadline_exceeded'] += 1
+            raise DeadlineExceeded("échéance dépassée")
+        return restant
+
+    def _idempotent(self, fonction, *args):
+        """
+        Exécute une requête idempotente fonction(*args), en la regroupant
+        avec les requêtes identiques déjà en cours si coalesce est actif.
+        """
+        if not self._coalesce:
+            return self._couvrir(fonction, *args)
+        # la session fait partie de la clef : deux sessions différentes
+        # peuvent voir des réponses différentes
+        cle = (fonction.__name__, json.dumps(args, sort_keys=True), self._session)
+        echeance = getattr(self._local, 'echeance', None)
+        while True:
+            with self._verrou:
+                vol = self._en_vol.get(cle)
+                meneur = vol is None
+                if meneur:
+                    vol = self._en_vol[cle] = _Vol(echeance)
+            if meneur:
+                break
+
+            # on attend le résultat de la requête en cours, sans dépasser
+            # notre propre échéance (_restant() lève DeadlineExceeded)
+            while not vol.fini.wait(self._restant()):
+                pass
+            if vol.echeance_depassee and (echeance is None or echeance > vol.echeance):
+                # le meneur a manqué sa propre échéance, plus proche que la
+                # nôtre : on recommence (en rejoignant une autre requête, ou
+                # en devenant meneur). Un simple délai de connexion ou de
+                # lecture écoulé est en revanche partagé comme toute erreur.
+                continue
+            with self._verrou:
+                self._stats['coalesced'] += 1
+            if vol.erreur is not None:
+                raise vol.erreur
+            # chaque appelant reçoit sa propre copie, qu'il peut modifier
+            return _copie(vol.resultat)
+
+        try:
+            resultat = self._couvrir(fonction, *args)
+            # copie faite une seule fois, avant de réveiller les autres
+            # appelants : le meneur garde l'original, qu'il peut modifier
+            vol.resultat = _copie(resultat)
+            return resultat
+        except BaseException as e:
+            vol.erreur = e
+            vol.echeance_depassee = (isinstance(e, DeadlineExceeded) and echeance is not None
+                                     and time.monotonic() >= echeance)
+            raise
+        finally:
+            with self._verrou:
+                del self._en_vol[cle]
+            vol.fini.set()
+
+    def _couvrir(self, fonction, *args):
+        """
+        Exécute fonction(*args). Si les requêtes couvertes sont activées et
+        que la réponse tarde plus que le centile choisi des latences passées,
+        on en envoie une copie, et on renvoie la première réponse obtenue.
         """
-        if 'Content-Type' in http_headers:
-            if http_headers['Content-Type'] == "application/json":
-                return json.loads(result.decode())
-            if http_headers['Content-Type'].startswith("text/plain"):
-                return result.decode()
-        # on ne sait pas ce que c'est : on laisse tel quel
-        return result
+        seuil = self._seuil_copie()
+        debut = time.monotonic()
+        if seuil is None:
+            resultat = fonction(*args)
+            self._mesurer(time.monotonic() - debut)
+            return resultat
+
+        echeance = getattr(self._local, 'echeance', None)
+        with self._verrou:
+            if self._pool_copies is None:
+                self._pool_copies = concurrent.futures.ThreadPoolExecutor(32)
+        # l'échéance est locale au thread : on la transmet aux threads du pool
+        futurs = [self._pool_copies.submit(self._avec_echeance, echeance, fonction, *args)]
+        fini, _ = concurrent.futures.wait(futurs, timeout=_minimum(seuil, self._restant()))
+        if not fini:
+            futurs.append(self._pool_copies.submit(self._avec_echeance, echeance, fonction, *args))
+            with self._verrou:
+                self._stats['hedges_sent'] += 1
+        erreur = None
+        for futur in concurrent.futures.as_completed(futurs):
+            try:
+                resultat = futur.result()
+            except Exception as e:
+                # on attend l'autre copie avant d'abandonner
+                if erreur is None:
+                    erreur = e
+                continue
+            self._mesurer(time.monotonic() - debut)
+            if futur is not futurs[0]:
+                with self._verrou:
+                    self._stats['hedges_won'] += 1
+            return resultat
+        raise erreur
+
+    def _avec_echeance(self, echeance, fonction, *args):
+        self._local.echeance = echeance
+        try:
+            return fonction(*args)
+        finally:
+            self._local.echeance = None
+
+    def _mesurer(self, latence):
+        with self._verrou:
+            self._latences.append(latence)
+
+    def _seuil_copie(self):
+        if self._hedge_percentile is None:
+            return None
+        with self._verrou:
+            if len(self._latences) < self.HEDGE_MIN_SAMPLES:
+                return None
+            latences = sorted(self._latences)
+        return latences[min(len(latences) - 1, int(self._hedge_percentile * len(latences)))]
 
     def _query(self, url, request, data=None):
         """
         Cette fonction à usage interne est appelée par get(), post(), put(),
         etc. Elle reçoit en argument une url et un objet Request() du module
         standard urllib.request.
+
+        Si la connexion a un contrôleur de débit, la requête attend son
+        autorisation, et elle est renvoyée si le serveur la refuse pour
+        surcharge.
+        """
+        if self._controleur is None:
+            return self._envoyer(url, request, data)
+        tentative = 0
+        while True:
+            jeton = self._controleur.acquerir(url, self._restant())
+            if jeton is None:
+                self._restant()
+                raise DeadlineExceeded("{} : pas d'autorisation d'envoi à temps".format(url))
+            debut = time.monotonic()
+            try:
+                resultat = self._envoyer(url, request, data)
+            except ServerError as e:
+                retry_after = lire_retry_after(_entete(e.headers, 'Retry-After'))
+                self._controleur.liberer(jeton, e.code, time.monotonic() - debut, retry_after)
+                if e.code in CODES_SURCHARGE and tentative < self._retries:
+                    # le contrôleur a mis le point d'accès en pause : la
+                    # prochaine autorisation attendra la fin de la pause
+                    tentative += 1
+                    with self._verrou:
+                        self._stats['retries'] += 1
+                    continue
+                raise
+            except BaseException:
+                self._controleur.liberer(jeton, None, time.monotonic() - debut)
+                raise
+            self._controleur.liberer(jeton, 200, time.monotonic() - debut)
+            return resultat
+
+    def _envoyer(self, url, request, data=None):
+        """
+        Envoie effectivement la requête et renvoie la réponse décodée.
         """
         self._pre_process(request)
+        # délais de connexion et de lecture, bornés par l'échéance courante
+        restant = self._restant()
+        connect_timeout = _minimum(self._connect_timeout, restant)
+        request.read_timeout = _minimum(self._read_timeout, restant)
+        if connect_timeout is None:
+            connect_timeout = socket._GLOBAL_DEFAULT_TIMEOUT
         try:           
             # lance la requête. Si data n'est pas None, la requête aura un
             # corps non-vide, avec data dedans.
-            with urllib.request.urlopen(request, data) as connexion:
+            with _opener.open(request, data, connect_timeout) as connexion:
                 # récupère les en-têtes HTTP et le corps de la réponse, puis
-                # ferme la connection
+                # ferme la connection. On lit par morceaux pour vérifier
+                # l'échéance même si le serveur envoie la réponse au
+                # compte-gouttes.
                 headers = dict(connexion.info())
-                result = connexion.read()
+                morceaux = []
+                while True:
+                    morceau = connexion.read1(65536)
+                    if not morceau:
+                        break
+                    morceaux.append(morceau)
+                    self._restant()
+                result = b''.join(morceaux)
             
             # si on reçoit un identifiant de session, on le stocke
             if 'Set-Cookie' in headers:
@@ -225,67 +786,91 @@ class Connection:
             # car il y a peut-être des explications dedans. On a besoin des
             # en-tête pour le post-processing.
             headers = dict(e.headers)
-            message = e.read()
-            raise ServerError(e.code, self._post_process(message, headers)) from None
+            message = self._post_process(e.read(), headers)
+            # le message d'erreur est toujours décodé, même en décodage différé
+            if isinstance(message, ContenuDiffere):
+                message = message.valeur
+            raise ServerError(e.code, message, headers) from None
+
+        except (socket.timeout, urllib.error.URLError) as e:
+            # délai de connexion ou de lecture écoulé (urllib enveloppe les
+            # erreurs de connexion dans une URLError)
+            if isinstance(e, urllib.error.URLError) and not isinstance(e.reason, socket.timeout):
+                raise
+            with self._verrou:
+                self._stats['timeouts'] += 1
+            raise DeadlineExceeded("{} : pas de réponse à temps".format(url)) from None
 
 class connexion2(Connection): 
-    def __init__ (self, mode, login, password, base_url = "http://isec.fil.cool/uglix"): 
+    def __init__ (self, mode, login, password, base_url = "http://isec.fil.cool/uglix", **options): 
+        # options : deadline, connect_timeout, read_timeout... (cf. Connection)
         self.mode = mode.lower()
         self.login = login 
         self.password = password 
         self.K = None
-        super().__init__(base_url)
-        if self.mode == "chap": 
-            challenge = self.get('/bin/login/CHAP')
-            challenge = challenge['challenge']
-            cipher = encrypt(login + '-' + challenge, password)
-            res = self.post('/bin/login/CHAP', user = login, response = cipher)
-            print(res)
-        if self.mode == "stp": 
-            nonce = super().post('/bin/login/stp', username = self.login)
-            self.K = '{}-{}'.format(self.password, nonce)
-            url = '/bin/login/stp/handshake'
-            print(self.get(url))
-        if self.mode == "dh": 
-            ca = super().get("/bin/banks/CA")
-            parameters = super().get('/bin/login/dh/parameters')
-            p = parameters['p']
-            g = parameters['g']
-            x = randint(3,10)
-            A = (g**x)%p
-            res = super().post('/bin/login/dh', username = login, A = A)
-            B = res['B']
-            k = res['k']
-            signature = res['signature']
-            S = "{},{},{},{}".format(A,B,k,login)
-            pk = recuperer_cle_public(ca)
-            verif = verification_signature_carte(pk,signature, S)
-            if not verif:
-                print('Erreur connexion dh')
-            AB = (B**x) % p
-            size = 1 + AB.bit_length() // 8
-            self.K = sha256(AB.to_bytes(size, byteorder='big')).hexdigest()
-            T = "{},{},{},UGLIX".format(A,B,k)
-            T = signatures(T, 'key_private.pub')
-            print(self.post('/bin/login/dh/confirmation', signature = T))
+        super().__init__(base_url, **options)
+        # la poignée de main a besoin des réponses décodées : le décodage
+        # différé (decodage_differe) ne s'applique qu'une fois connecté
+        differe, self._decodage_differe = self._decodage_differe, False
+        try:
+            if self.mode == "chap": 
+                challenge = self.get('/bin/login/CHAP')
+                challenge = challenge['challenge']
+                cipher = encrypt(login + '-' + challenge, password)
+                res = self.post('/bin/login/CHAP', user = login, response = cipher)
+                print(res)
+            if self.mode == "stp": 
+                nonce = super().post('/bin/login/stp', username = self.login)
+                self.K = '{}-{}'.format(self.password, nonce)
+                url = '/bin/login/stp/handshake'
+                print(self.get(url))
+            if self.mode == "dh": 
+                # le certificat de l'autorité et sa clef publique sont gardés en
+                # cache : pas de nouveau téléchargement ni de nouvelle analyse
+                ca = magasin_certificats.depuis_url(self, "/bin/banks/CA")
+                if not ca.valide():
+                    print('Attention : certificat CA hors de sa période de validité')
+                parameters = super().get('/bin/login/dh/parameters')
+                p = parameters['p']
+                g = parameters['g']
+                x = randint(3,10)
+                A = (g**x)%p
+                res = super().post('/bin/login/dh', username = login, A = A)
+                B = res['B']
+                k = res['k']
+                signature = res['signature']
+                S = "{},{},{},{}".format(A,B,k,login)
+                pk = ca.cle_publique
+                verif = verification_signature_carte(pk,signature, S)
+                if not verif:
+                    print('Erreur connexion dh')
+                AB = (B**x) % p
+                size = 1 + AB.bit_length() // 8
+                self.K = sha256(AB.to_bytes(size, byteorder='big')).hexdigest()
+                T = "{},{},{},UGLIX".format(A,B,k)
+                T = signatures(T, 'key_private.pub')
+                print(self.post('/bin/login/dh/confirmation', signature = T))
+        finally:
+            self._decodage_differe = differe
+
+    def __getstate__(self):
+        """
+        La poignée d'une connexion authentifiée contient aussi le mode, le
+        login et la clef de session K : on la reconstruit dans un autre
+        processus sans refaire de poignée de main. Le mot de passe, inutile
+        une fois connecté, n'est pas transmis.
+        """
+        etat = super().__getstate__()
+        etat['password'] = None
+        return etat
 
     def get(self, url): 
         if self.mode == "chap": 
             return super().get(url)
         if ((self.mode == "stp" )| (self.mode == "dh")): 
             requete = {'method': "GET", 'url': url}
-            requete_json = json.dumps(requete)
-            requete_chiffre = encrypt2(requete_json, self.K)
-            resultat = super().post_raw(url = '/bin/gateway', data = requete_chiffre, content_type='application/octet-stream')
-            resultat = base64.b64encode(resultat).decode()
-            with open("tmp.txt", 'w') as f: 
-                for i in range(0, len(resultat)): 
-                    if (i % 64 == 0): 
-                        f.write("\n")
-                    f.write(resultat[i])
-            # with open("tmp.txt", "r") as f: 
-            #     res = f.read()
-            return decrypt("tmp.txt", self.K)
+            with self._operation():
+                return self._idempotent(self._passerelle, requete)
 
 
     def post(self, url, **kwargs): 
@@ -293,18 +878,60 @@ class connexion2(Connection):
             return super().post(url, **kwargs)
         if ((self.mode == "stp" )| (self.mode == "dh")): 
             requete = {'method': "POST", 'url': url, "args": kwargs}
-            requete_json = json.dumps(requete)
-            requete_chiffre = encrypt2(requete_json, self.K)
-            resultat = super().post_raw(url = '/bin/gateway', data = requete_chiffre, content_type='application/octet-stream')
-            resultat = base64.b64encode(resultat).decode()
-            with open("tmp.txt", 'w') as f: 
-                for i in range(0, len(resultat)): 
-                    if (i % 64 == 0): 
-                        f.write("\n")
-                    f.write(resultat[i])
-            # with open("tmp.txt", "r") as f: 
-            #     res = f.read()
-            return decrypt("tmp.txt", self.K)
+            with self._operation():
+                return self._passerelle(requete)
+
+    def _passerelle(self, requete):
+        """
+        Envoie une requête chiffrée à la passerelle (modes stp et dh), puis
+        déchiffre la réponse. La passerelle n'indique pas le type de contenu
+        de la réponse : on le devine, puis on la décode avec le registre des
+        codecs, comme une réponse ordinaire. Un JSON est renvoyé décodé, du
+        texte sous forme de str(), un contenu binaire sous forme de bytes()
+        (ou de memoryview, si l'on enregistre un codec pour
+        'application/octet-stream').
+
+        L'échéance courante couvre tout l'aller-retour, chiffrement compris :
+        un processus openssl qui la dépasse est tué.
+        """
+        requete_json = json.dumps(requete)
+        requete_chiffre = self._openssl(encrypt2, requete_json, self.K)
+        self._restant()
+        resultat = super().post_raw(url = '/bin/gateway', data = requete_chiffre, content_type='application/octet-stream')
+        if isinstance(resultat, ContenuDiffere):
+            resultat = resultat.brut
+        # la réponse est le chiffré binaire lui-même : on le déchiffre
+        # directement, sans base64 ni fichier temporaire, et sans decode()
+        # (le clair peut être binaire, comme les fichiers .bin de /home)
+        resultat = self._openssl(decrypt2, resultat, self.K)
+        # le contenu a déjà été décodé pour en deviner le type : on ne le
+        # décode pas une seconde fois
+        content_type, valeur = _deviner(resultat)
+        return self._decoder(resultat, content_type, valeur)
+
+    def _openssl(self, fonction, *args):
+        """
+        Appelle fonction (encrypt2 ou decrypt2) avec le temps restant avant
+        l'échéance courante comme délai ; déclenche DeadlineExceeded si
+        openssl ne termine pas à temps.
+        """
+        try:
+            return fonction(*args, timeout=self._restant())
+        except subprocess.TimeoutExpired:
+            with self._verrou:
+                self._stats['deadline_exceeded'] += 1
+            raise DeadlineExceeded("openssl n'a pas terminé à temps") from None
+
+    def synchroniser(self, repertoire, destination=None, concurrence=4, manifeste=None, forcer=False):
+        """
+        Envoie en parallèle les fichiers de repertoire vers destination (par
+        défaut '/home/<login>/'), en ignorant ceux qui n'ont pas changé depuis
+        le dernier envoi. Renvoie le bilan (fichiers et octets envoyés et
+        ignorés, erreurs). cf. synchronisation.py
+        """
+        if destination is None:
+            destination = '/home/{}/'.format(self.login)
+        return synchronisation.synchroniser(self, repertoire, destination, concurrence, manifeste, forcer)
 
     def piece_jointe(self, nom_bureau, numero, attachement): 
         return self.get('{}/ticket/{}/attachment/{}'.format(nom_bureau, numero, attachement))
@@ -334,6 +961,48 @@ class connexion2(Connection):
         return (r[i-1], u[i-1], v[i-1])
          
 
+################################################################################
+#                          RÉPARTITION SUR PLUSIEURS PROCESSUS                 #
+################################################################################
+
+# connexion du processus courant, installée par _initialiser_processus()
+_connexion_processus = None
+
+
+def repartir(fonction, entrees, connexion, processes=None, chunksize=1):
+    """
+    Applique fonction(connexion, entree) à chaque entrée, en parallèle dans
+    un pool de processus, et renvoie la liste des résultats dans l'ordre des
+    entrées. Chaque processus reçoit une seule fois sa propre copie de la
+    connexion (déjà authentifiée : pas de nouvelle poignée de main) et la
+    réutilise pour toutes ses entrées.
+
+    fonction doit pouvoir être sérialisée (définie au niveau d'un module).
+    processes est le nombre de processus (par défaut, le nombre de
+    processeurs) ; chunksize le nombre d'entrées envoyées d'un coup à un
+    processus.
+
+    >>> c = connexion2('dh', login, password)
+    >>> resultats = repartir(attaque_oracle, blocs, c, processes=8)
+    """
+    # la connexion est sérialisée explicitement : avec fork, initargs n'est
+    # pas sérialisé, et chaque processus hériterait d'une copie brute de la
+    # connexion (verrous, pool de threads sans threads, requêtes en vol...)
+    poignee = pickle.dumps(connexion)
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=_initialiser_processus,
+                                                initargs=(poignee,)) as pool:
+        return list(pool.map(functools.partial(_appeler, fonction), entrees, chunksize=chunksize))
+
+
+def _initialiser_processus(poignee):
+    global _connexion_processus
+    _connexion_processus = pickle.loads(poignee)
+
+
+def _appeler(fonction, entree):
+    return fonction(_connexion_processus, entree)
+
+
 # vérifie l'authenticité de la signature du serveur
 from zlib import decompress as Y
 from base64 import b85decode as Z
@@ -362,3 +1031,10 @@ algorithm  = 'c%1E6%?^Sv41Sdz+gI32aAjT$$PPw~Mx$Xoy>3opbO`%VssahDw3N2rSDFm!VqI' \
 signature = eval(Y(Z(algorithm)))
 if not signature.startswith(b'S50|UU'):
     raise ValueError("ATTENTION : le serveur a été hacké !")
+
+
+if __name__ == '__main__':
+    # python -m client batch ...  (cf. batch.py)
+    import sys
+    import batch
+    sys.exit(batch.main(sys.argv[1:]))
@@ -0,0 +1,261 @@
+"""Contrôle adaptatif du débit et de la concurrence des requêtes.
+
+Quand on pousse Connection trop fort, le serveur répond par des erreurs
+HTTP (429 Too Many Requests, 503 Service Unavailable) qui remontent sous
+forme de ServerError, et nos boucles continuent de plus belle. Le
+contrôleur applique côté client :
+
+    - un seau à jetons par point d'accès (débit maximal en requêtes par
+      seconde, avec une rafale autorisée) ;
+    - une limite sur le nombre de requêtes en vol, ajustée en AIMD : +1 par
+      « aller-retour » réussi, divisée par deux sur un 429/503 ou, si
+      latence_cible est donnée, réduite quand la latence la dépasse ;
+    - une pause du point d'accès pendant la durée indiquée par l'en-tête
+      Retry-After.
+
+Le même contrôleur peut être partagé par plusieurs connexions et threads
+(acquerir()) et par du code asyncio (acquerir_async()) :
+
+    >>> ctrl = ControleurDebit(debit=20, limite_max=16)
+    >>> c = connexion2("chap", login, password, controleur=ctrl)
+    >>> ctrl.statistiques()
+    {'limite': 9.1, 'en_vol': 3, 'file': 5, 'temps_bride': 1.52, ...}
+"""
+import asyncio
+import collections
+import email.utils
+import re
+import threading
+import time
+import urllib.parse
+
+
+# codes HTTP qui signalent une surcharge du serveur
+CODES_SURCHARGE = (429, 503)
+
+_SEGMENT_NUMERIQUE = re.compile(r'/\d+(?=/|$)')
+
+
+def cle_endpoint(url):
+    """
+    Point d'accès d'une URL : son chemin, sans la requête, où les segments
+    numériques sont remplacés par '*' ('/bin/police_hq/ticket/1496' devient
+    '/bin/police_hq/ticket/*').
+    """
+    chemin = urllib.parse.urlsplit(url).path
+    return _SEGMENT_NUMERIQUE.sub('/*', chemin)
+
+
+def lire_retry_after(valeur):
+    """
+    Convertit un en-tête Retry-After (nombre de secondes ou date HTTP) en
+    nombre de secondes. Renvoie None si l'en-tête est absent ou illisible.
+    """
+    if valeur is None:
+        return None
+    valeur = valeur.strip()
+    if valeur.isdigit():
+        return float(valeur)
+    try:
+        date = email.utils.parsedate_to_datetime(valeur)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class Jeton:
+    """Autorisation d'envoyer une requête, à rendre avec liberer()."""
+    __slots__ = ('cle', 'depart')
+
+    def __init__(self, cle, depart):
+        self.cle = cle
+        self.depart = depart
+
+
+class _Seau:
+    def __init__(self, debit, rafale):
+        self.debit = debit
+        self.rafale = rafale
+        self.jetons = rafale
+        self.dernier = time.monotonic()
+        self.pause = 0.0        # pas de requête avant cette date (Retry-After)
+
+    def remplir(self, maintenant):
+        if self.debit is not None:
+            self.jetons = min(self.rafale, self.jetons + (maintenant - self.dernier) * self.debit)
+        self.dernier = maintenant
+
+
+class ControleurDebit:
+    """
+    debit : nombre maximal de requêtes par seconde et par point d'accès
+    (None : pas de limite), debits : débits particuliers de certains points
+    d'accès ({'/bin/gateway': 5}), rafale : nombre de requêtes qu'un point
+    d'accès peut envoyer d'un coup (par défaut, une seconde de débit).
+
+    limite_initiale, limite_min et limite_max encadrent le nombre de requêtes
+    en vol ; latence_cible (en secondes) active la réduction de la limite
+    quand le serveur ralentit ; pause_defaut est la pause appliquée à un
+    point d'accès sur un 429/503 sans Retry-After.
+    """
+    def __init__(self, debit=None, rafale=None, debits=None, limite_initiale=4, limite_min=1,
+                 limite_max=64, latence_cible=None, pause_defaut=1.0, cle_endpoint=cle_endpoint):
+        self.debit = debit
+        self.rafale = rafale
+        self.debits = dict(debits or {})
+        self.limite_min = limite_min
+        self.limite_max = limite_max
+        self.latence_cible = latence_cible
+        self.pause_defaut = pause_defaut
+        self.cle_endpoint = cle_endpoint
+        self._limite = float(max(limite_min, min(limite_initiale, limite_max)))
+        self._en_vol = 0
+        self._file = 0
+        self._seaux = {}
+        self._derniere_baisse = 0.0
+        self._stats = collections.Counter()
+        self._temps_bride = 0.0
+        self._cond = threading.Condition()
+
+    ############################################################################
+    #                          MÉTHODES PUBLIQUES                              #
+    ############################################################################
+
+    def acquerir(self, url, timeout=None):
+        """
+        Attend (en bloquant le thread) le droit d'envoyer une requête vers
+        url, et renvoie un Jeton. Renvoie None si timeout secondes se sont
+        écoulées sans obtenir ce droit.
+        """
+        cle = self.cle_endpoint(url)
+        debut = time.monotonic()
+        with self._cond:
+            self._file += 1
+            try:
+                while True:
+                    attente = self._essayer(cle)
+                    if attente == 0:
+                        return Jeton(cle, time.monotonic())
+                    if timeout is not None:
+                        restant = timeout - (time.monotonic() - debut)
+                        if restant <= 0:
+                            self._stats['timeouts'] += 1
+                            return None
+                        attente = restant if attente is None else min(attente, restant)
+                    # attente vaut None si l'on attend qu'une requête se
+                    # termine : liberer() nous réveillera
+                    self._cond.wait(attente)
+            finally:
+                self._file -= 1
+                self._temps_bride += time.monotonic() - debut
+
+    async def acquerir_async(self, url, timeout=None):
+        """
+        Version asyncio de acquerir() : attend sans bloquer la boucle
+        d'événements.
+        """
+        cle = self.cle_endpoint(url)
+        debut = time.monotonic()
+        with self._cond:
+            self._file += 1
+        try:
+            while True:
+                with self._cond:
+                    attente = self._essayer(cle)
+                if attente == 0:
+                    return Jeton(cle, time.monotonic())
+                if timeout is not None:
+                    restant = timeout - (time.monotonic() - debut)
+                    if restant <= 0:
+                        with self._cond:
+                            self._stats['timeouts'] += 1
+                        return None
+                    attente = restant if attente is None else min(attente, restant)
+                # pas de notification possible depuis un autre thread : on
+                # revérifie régulièrement quand on attend une place
+                await asyncio.sleep(0.01 if attente is None else min(attente, 0.25))
+        finally:
+            with self._cond:
+                self._file -= 1
+                self._temps_bride += time.monotonic() - debut
+
+    def liberer(self, jeton, code=None, latence=None, retry_after=None):
+        """
+        Rend un jeton une fois la requête terminée. code est le code HTTP
+        obtenu (None en cas d'erreur réseau), latence la durée de la requête
+        et retry_after la valeur (en secondes) de l'en-tête Retry-After.
+        """
+        with self._cond:
+            self._en_vol -= 1
+            if code in CODES_SURCHARGE:
+                self._stats['throttled'] += 1
+                seau = self._seaux[jeton.cle]
+                pause = retry_after if retry_after is not None else self.pause_defaut
+                seau.pause = max(seau.pause, time.monotonic() + pause)
+                self._reduire(jeton, 0.5)
+            elif code is not None and code < 400:
+                self._stats['ok'] += 1
+                if self.latence_cible is not None and latence is not None and latence > self.latence_cible:
+                    self._stats['slow'] += 1
+                    self._reduire(jeton, 0.9)
+                else:
+                    # augmentation additive : environ +1 par fenêtre complète
+                    self._limite = min(self.limite_max, self._limite + 1 / self._limite)
+            else:
+                self._stats['errors'] += 1
+            self._cond.notify_all()
+
+    def statistiques(self):
+        """
+        Renvoie l'état courant : limite de requêtes en vol, requêtes en vol,
+        appelants en attente (file), temps passé à attendre une autorisation
+        (en secondes, cumulé sur tous les appelants), points d'accès en pause
+        et compteurs de réponses.
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(limite=round(self._limite, 2), en_vol=self._en_vol, file=self._file,
+                         temps_bride=round(self._temps_bride, 3))
+            maintenant = time.monotonic()
+            stats['en_pause'] = sorted(cle for cle, seau in self._seaux.items() if seau.pause > maintenant)
+            return stats
+
+    ############################################################################
+    #                          MÉTHODES INTERNES                               #
+    ############################################################################
+
+    def _seau(self, cle):
+        seau = self._seaux.get(cle)
+        if seau is None:
+            debit = self.debits.get(cle, self.debit)
+            rafale = self.rafale if self.rafale is not None else max(1.0, debit or 1.0)
+            seau = self._seaux[cle] = _Seau(debit, rafale)
+        return seau
+
+    def _essayer(self, cle):
+        """
+        Prend une place et un jeton si possible (renvoie 0). Sinon, renvoie
+        le temps à attendre avant de réessayer, ou None s'il faut attendre
+        qu'une requête en vol se termine. Appelée sous self._cond.
+        """
+        maintenant = time.monotonic()
+        seau = self._seau(cle)
+        if maintenant < seau.pause:
+            return seau.pause - maintenant
+        if self._en_vol >= int(self._limite):
+            return None
+        seau.remplir(maintenant)
+        if seau.debit is not None:
+            if seau.jetons < 1:
+                return (1 - seau.jetons) / seau.debit
+            seau.jetons -= 1
+        self._en_vol += 1
+        return 0
+
+    def _reduire(self, jeton, facteur):
+        # une seule réduction par salve : les requêtes parties avant la
+        # dernière réduction ont été envoyées avec l'ancienne limite
+        if jeton.depart <= self._derniere_baisse:
+            return
+        self._limite = max(self.limite_min, self._limite * facteur)
+        self._derniere_baisse = time.monotonic()
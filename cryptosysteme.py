@@ -0,0 +1,385 @@
+"""Cryptosystèmes RSA et ElGamal pour le client.
+
+Dans les notebooks, on déchiffre ElGamal avec y1**a (sans modulo, donc avec
+un entier gigantesque) suivi de euclide_etendu(), et on fait du RSA avec des
+pow() bruts sur les entiers lus dans les pièces jointes. Ces classes font la
+même chose, mais correctement et plus vite :
+
+    - RSA déchiffre et signe avec le théorème des restes chinois (CRT)
+      quand la factorisation de n est connue ;
+    - ElGamal chiffre avec des tables de précalcul pour les bases fixes g et
+      h, ce qui remplace les élévations au carré par des lectures de table ;
+    - les méthodes *_lot() traitent plusieurs chiffrés à la fois et
+      n'effectuent qu'une seule inversion modulaire pour tout le lot
+      (astuce de Montgomery).
+
+Exemple :
+    >>> p = int(c.piece_jointe("/bin/hackademy", "1508", "p"))
+    >>> g = int(c.piece_jointe("/bin/hackademy", "1508", "g"))
+    >>> eg = ElGamal(p, g, x=5)
+    >>> reponse = c.post("/bin/hackademy/exam/elgamal/decryption", h=eg.h)
+    >>> entier_vers_bytes(eg.dechiffrer(*reponse['ciphertext']))
+
+    >>> rsa = RSA.depuis_exposants(n, e, d)     # retrouve p et q
+    >>> rsa.p * rsa.q == n
+    True
+
+Lancer ``python cryptosysteme.py`` compare ces classes aux formules naïves
+de hackademy.ipynb.
+"""
+import random
+import subprocess
+import time
+
+from openssl import OpensslError
+
+
+############################################################################
+#                          MÉTHODES PUBLIQUES                              #
+############################################################################
+
+def entier_vers_bytes(m):
+    """Convertit un entier en bytes() (remplace hex(m)[2:] puis unhexlify())."""
+    return m.to_bytes((m.bit_length() + 7) // 8, 'big')
+
+
+def bytes_vers_entier(data):
+    """Convertit un bytes() ou un str() (encodé en UTF-8) en entier."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return int.from_bytes(data, 'big')
+
+
+def inverses_lot(valeurs, modulo):
+    """
+    Inverse tous les éléments de valeurs modulo modulo, avec une seule
+    inversion modulaire et 3(k-1) multiplications (astuce de Montgomery).
+    Déclenche ValueError si l'un des éléments n'est pas inversible.
+    """
+    valeurs = [v % modulo for v in valeurs]
+    if not valeurs:
+        return []
+    # produits[i] = valeurs[0] * ... * valeurs[i]
+    produits = [valeurs[0]]
+    for v in valeurs[1:]:
+        produits.append(produits[-1] * v % modulo)
+    inverse = pow(produits[-1], -1, modulo)
+    resultat = [0] * len(valeurs)
+    for i in range(len(valeurs) - 1, 0, -1):
+        resultat[i] = inverse * produits[i - 1] % modulo
+        inverse = inverse * valeurs[i] % modulo
+    resultat[0] = inverse
+    return resultat
+
+
+class BaseFixe:
+    """
+    Exponentiation modulaire rapide pour une base fixe. On précalcule
+    base^(j * 2^(w*i)) pour tous les j < 2^w ; une exponentiation ne coûte
+    alors plus qu'une multiplication par tranche de w bits de l'exposant,
+    au lieu d'une élévation au carré par bit.
+
+    La table occupe environ (bits / w) * 2^w entiers : avec w = 4 et un
+    modulo de 2048 bits, cela fait 8192 entiers, soit 2 Mo.
+    """
+    def __init__(self, base, modulo, bits=None, w=4):
+        self.base = base % modulo
+        self.modulo = modulo
+        self.w = w
+        self.bits = bits or modulo.bit_length()
+        self._masque = (1 << w) - 1
+        self._table = []
+        b = self.base
+        for _ in range((self.bits + w - 1) // w):
+            ligne = [1]
+            for _ in range(self._masque):
+                ligne.append(ligne[-1] * b % modulo)
+            self._table.append(ligne)
+            # base^(2^w) pour la tranche suivante
+            b = ligne[-1] * b % modulo
+
+    def pow(self, exposant):
+        """Renvoie base^exposant mod modulo."""
+        if exposant < 0 or exposant.bit_length() > self.bits:
+            return pow(self.base, exposant, self.modulo)
+        modulo = self.modulo
+        resultat = 1
+        for ligne in self._table:
+            if not exposant:
+                break
+            j = exposant & self._masque
+            if j:
+                resultat = resultat * ligne[j] % modulo
+            exposant >>= self.w
+        return resultat
+
+
+class RSA:
+    """
+    Clef RSA. Seuls n et e sont obligatoires (clef publique) ; d permet de
+    déchiffrer et de signer, et p, q permettent de le faire avec le CRT,
+    environ trois fois plus vite qu'avec pow(c, d, n).
+    """
+    def __init__(self, n, e, d=None, p=None, q=None):
+        self.n = int(n)
+        self.e = int(e)
+        self.d = int(d) if d is not None else None
+        self.p = int(p) if p is not None else None
+        self.q = int(q) if q is not None else None
+        if self.p is not None and self.q is not None:
+            if self.p * self.q != self.n:
+                raise ValueError("p * q != n")
+            if self.d is None:
+                self.d = pow(self.e, -1, (self.p - 1) * (self.q - 1))
+            self._dp = self.d % (self.p - 1)
+            self._dq = self.d % (self.q - 1)
+            self._q_inv = pow(self.q, -1, self.p)
+
+    @classmethod
+    def generer(cls, bits=2048, e=65537):
+        """Génère une nouvelle clef RSA de bits bits (les premiers sont tirés par openssl)."""
+        while True:
+            p = _premier_openssl(bits // 2)
+            q = _premier_openssl(bits - bits // 2)
+            phi = (p - 1) * (q - 1)
+            if p != q and _pgcd(e, phi) == 1:
+                return cls(p * q, e, p=p, q=q)
+
+    @classmethod
+    def depuis_exposants(cls, n, e, d):
+        """
+        Retrouve la factorisation de n à partir de e et d (comme dans le
+        ticket 1512 de hackademy.ipynb) et renvoie la clef complète, qui
+        profite donc du CRT.
+        """
+        n, e, d = int(n), int(e), int(d)
+        k = e * d - 1
+        t = 0
+        while k % 2 == 0:
+            k //= 2
+            t += 1
+        aleatoire = random.SystemRandom()
+        for _ in range(100):
+            x = aleatoire.randrange(2, n - 1)
+            y = pow(x, k, n)
+            for _ in range(t):
+                z = y * y % n
+                if z == 1 and y != 1 and y != n - 1:
+                    p = _pgcd(y - 1, n)
+                    return cls(n, e, d, p, n // p)
+                y = z
+        raise ValueError("impossible de factoriser n avec ces exposants")
+
+    def chiffrer(self, m):
+        return pow(int(m), self.e, self.n)
+
+    def verifier(self, m, s):
+        """Vérifie une signature RSA « brute » (sans padding)."""
+        return pow(int(s), self.e, self.n) == int(m) % self.n
+
+    def dechiffrer(self, c):
+        c = int(c)
+        if self.d is None:
+            raise ValueError("clef privée inconnue")
+        if self.p is None:
+            return pow(c, self.d, self.n)
+        # CRT : deux exponentiations de taille moitié, puis recombinaison
+        # (formule de Garner)
+        mp = pow(c % self.p, self._dp, self.p)
+        mq = pow(c % self.q, self._dq, self.q)
+        h = self._q_inv * (mp - mq) % self.p
+        return mq + h * self.q
+
+    # une signature RSA « brute » est un déchiffrement
+    signer = dechiffrer
+
+    def chiffrer_lot(self, messages):
+        return [self.chiffrer(m) for m in messages]
+
+    def dechiffrer_lot(self, chiffres):
+        return [self.dechiffrer(c) for c in chiffres]
+
+    signer_lot = dechiffrer_lot
+
+    def multiplier(self, c, k):
+        """
+        Renvoie le chiffré de k * m à partir du chiffré c de m (malléabilité
+        de RSA). Remplace (((2**i)**e) * C) % n de hackademy.ipynb.
+        """
+        return pow(int(k), self.e, self.n) * int(c) % self.n
+
+
+class ElGamal:
+    """
+    ElGamal dans le groupe multiplicatif modulo p, de générateur g. h = g^x
+    est la clef publique, x la clef privée (facultative).
+    """
+    def __init__(self, p, g, h=None, x=None, w=4):
+        self.p = int(p)
+        self.g = int(g)
+        self.x = int(x) if x is not None else None
+        if h is None:
+            if self.x is None:
+                raise ValueError("il faut h ou x")
+            h = pow(self.g, self.x, self.p)
+        self.h = int(h)
+        self._w = w
+        self._table_g = None
+        self._table_h = None
+
+    @classmethod
+    def generer(cls, p, g, w=4):
+        """Tire une clef privée aléatoire dans le groupe (p, g)."""
+        x = random.SystemRandom().randrange(2, int(p) - 1)
+        return cls(p, g, x=x, w=w)
+
+    def _tables(self):
+        # les tables sont construites au premier chiffrement seulement
+        if self._table_g is None:
+            self._table_g = BaseFixe(self.g, self.p, w=self._w)
+            self._table_h = BaseFixe(self.h, self.p, w=self._w)
+        return self._table_g, self._table_h
+
+    def chiffrer(self, m, k=None):
+        """Renvoie (y1, y2) = (g^k, m * h^k)."""
+        table_g, table_h = self._tables()
+        if k is None:
+            k = random.SystemRandom().randrange(1, self.p - 1)
+        return table_g.pow(k), int(m) * table_h.pow(k) % self.p
+
+    def dechiffrer(self, y1, y2):
+        """Renvoie m = y2 / y1^x."""
+        if self.x is None:
+            raise ValueError("clef privée inconnue")
+        s = pow(int(y1), self.x, self.p)
+        return int(y2) * pow(s, -1, self.p) % self.p
+
+    def chiffrer_lot(self, messages):
+        return [self.chiffrer(m) for m in messages]
+
+    def dechiffrer_lot(self, chiffres):
+        """
+        Déchiffre une liste de couples (y1, y2), avec une seule inversion
+        modulaire pour tout le lot.
+        """
+        if self.x is None:
+            raise ValueError("clef privée inconnue")
+        chiffres = [(int(y1), int(y2)) for y1, y2 in chiffres]
+        secrets = [pow(y1, self.x, self.p) for y1, _ in chiffres]
+        inverses = inverses_lot(secrets, self.p)
+        return [y2 * s % self.p for (_, y2), s in zip(chiffres, inverses)]
+
+
+############################################################################
+#                          MÉTHODES INTERNES                               #
+############################################################################
+
+def _pgcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+def _premier_openssl(bits):
+    args = ['openssl', 'prime', '-generate', '-bits', str(bits)]
+    result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    error_message = result.stderr.decode()
+    if result.returncode != 0 or error_message != '':
+        raise OpensslError(error_message)
+    return int(result.stdout.decode())
+
+
+def _euclide_etendu(a, b):
+    # copie de connexion2.euclide_etendu(), pour le benchmark
+    r = [a, b]
+    u = [1, 0]
+    v = [0, 1]
+    i = 1
+    while(r[i] != 0):
+        q = r[i-1]//r[i]
+        r.append(r[i-1]-q*r[i])
+        u.append(u[i-1]-q*u[i])
+        v.append(v[i-1]-q*v[i])
+        i = i+1
+    return (r[i-1], u[i-1], v[i-1])
+
+
+def _chrono(f, repetitions):
+    debut = time.perf_counter()
+    for _ in range(repetitions):
+        f()
+    return (time.perf_counter() - debut) / repetitions
+
+
+def benchmark(repetitions=3, lot=10):
+    """Compare les classes aux formules naïves de hackademy.ipynb."""
+    # groupe MODP de 2048 bits (RFC 3526, groupe 14)
+    p = int('FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74'
+            '020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437'
+            '4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED'
+            'EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05'
+            '98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB'
+            '9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B'
+            'E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718'
+            '3995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF', 16)
+    g = 2
+    aleatoire = random.Random(0)
+    print("ElGamal, p de {} bits".format(p.bit_length()))
+
+    # clef privée minuscule, comme dans le notebook (a = 5)
+    eg = ElGamal(p, g, x=5)
+    chiffres = [eg.chiffrer(aleatoire.randrange(2, p)) for _ in range(lot)]
+
+    def naif_petit():
+        for y1, y2 in chiffres:
+            r, inv, v = _euclide_etendu(y1**5, p)
+            (inv * y2) % p
+    _afficher("  déchiffrement, x = 5, y1**x + euclide_etendu",
+              _chrono(naif_petit, repetitions) / lot,
+              "dechiffrer_lot()", _chrono(lambda: eg.dechiffrer_lot(chiffres), repetitions) / lot)
+
+    # clef privée de taille réaliste : y1**x est impossible, on compare à
+    # pow() + euclide_etendu()
+    eg = ElGamal.generer(p, g)
+    chiffres = [eg.chiffrer(aleatoire.randrange(2, p)) for _ in range(lot)]
+
+    def naif():
+        for y1, y2 in chiffres:
+            r, inv, v = _euclide_etendu(pow(y1, eg.x, p), p)
+            (inv * y2) % p
+    _afficher("  déchiffrement, pow + euclide_etendu",
+              _chrono(naif, repetitions) / lot,
+              "dechiffrer_lot()", _chrono(lambda: eg.dechiffrer_lot(chiffres), repetitions) / lot)
+
+    messages = [aleatoire.randrange(2, p) for _ in range(lot)]
+
+    def naif_chiffrement():
+        for m in messages:
+            k = aleatoire.randrange(1, p - 1)
+            pow(g, k, p), m * pow(eg.h, k, p) % p
+    _afficher("  chiffrement, pow(g, k, p) et pow(h, k, p)",
+              _chrono(naif_chiffrement, repetitions) / lot,
+              "tables de base fixe", _chrono(lambda: eg.chiffrer_lot(messages), repetitions) / lot)
+
+    print("RSA, n de 2048 bits")
+    rsa = RSA.generer(2048)
+    chiffres = [aleatoire.randrange(2, rsa.n) for _ in range(lot)]
+    _afficher("  déchiffrement, pow(c, d, n)",
+              _chrono(lambda: [pow(c, rsa.d, rsa.n) for c in chiffres], repetitions) / lot,
+              "CRT", _chrono(lambda: rsa.dechiffrer_lot(chiffres), repetitions) / lot)
+
+    # étape de l'attaque du bit de poids fort : i va jusqu'à la taille de n,
+    # on se limite ici aux premières valeurs, déjà coûteuses
+    C = chiffres[0]
+    _afficher("  (((2**i)**e) * C) % n, i < 32",
+              _chrono(lambda: [(((2**i)**rsa.e)*C) % rsa.n for i in range(32)], 1) / 32,
+              "multiplier()", _chrono(lambda: [rsa.multiplier(C, 2**i) for i in range(32)], repetitions) / 32)
+
+
+def _afficher(naif, t_naif, nom, t):
+    print("{:<48} {:>10.1f} µs   {:<22} {:>10.1f} µs   x{:.1f}".format(
+        naif, t_naif * 1e6, nom, t * 1e6, t_naif / t))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,331 @@
+"""Chiffrement hybride (« enveloppe ») de gros fichiers.
+
+encrypt_public() ne peut chiffrer avec RSA que des messages plus courts que
+le module, et encrypt() fait passer tout le clair dans un seul appel à
+openssl. Ici on tire une clef symétrique aléatoire, on l'enveloppe avec la
+clef publique (RSA-OAEP) du destinataire, puis on chiffre le contenu par
+morceaux, en flux, avec AES-256-CTR. Chaque morceau est authentifié par un
+HMAC-SHA256 qui couvre son numéro et un drapeau « dernier morceau » : on
+détecte ainsi les modifications, les réordonnancements et les troncatures.
+
+La mémoire utilisée ne dépend que de la taille des morceaux, et un seul
+processus openssl chiffre tout le flux (pas un fork par morceau).
+
+Format :
+    MAGIC | longueur de l'enveloppe (2 octets) | enveloppe RSA | IV (16 octets)
+    | taille maximale d'un morceau (4 octets) | HMAC de tout ce qui précède
+    puis pour chaque morceau :
+    en-tête (4 octets : longueur, bit de poids fort = dernier) | chiffré | HMAC
+
+La taille maximale des morceaux est authentifiée avant la lecture du premier
+morceau : un en-tête de morceau falsifié qui annoncerait une longueur
+démesurée est refusé avant d'être lu, et le déchiffrement n'utilise jamais
+plus de mémoire que cette taille (elle-même bornée par TAILLE_MAX).
+
+Exemple :
+    >>> encrypt_file('gros.bin', 'gros.bin.enc', 'key_public.bin')
+    >>> decrypt_file('gros.bin.enc', 'gros.bin', 'key_private.pub')
+"""
+import hashlib
+import hmac
+import os
+import queue
+import struct
+import subprocess
+import threading
+
+from openssl import OpensslError
+
+
+MAGIC = b'UGLXHYB2'
+CHUNK_SIZE = 1 << 20        # taille des morceaux de clair (1 Mo)
+TAILLE_MAX = 1 << 26        # taille maximale acceptée pour un morceau (64 Mo)
+
+_CLEF_AES = 32
+_CLEF_MAC = 32
+_IV = 16
+_TAG = 32
+_DERNIER = 0x80000000
+
+
+class IntegrityError(OpensslError):
+    """
+    Exception déclenchée quand un chiffré hybride a été modifié, tronqué ou
+    n'a pas le bon format.
+    """
+    pass
+
+
+############################################################################
+#                          MÉTHODES PUBLIQUES                              #
+############################################################################
+
+def encrypt_stream(chunks, file_key, chunk_size=CHUNK_SIZE):
+    """
+    Chiffre un flux de clair pour le détenteur de la clef privée associée à
+    la clef publique (RSA, format PEM) contenue dans le fichier file_key.
+
+    chunks est un itérable de bytes() (ou str(), encodé en UTF-8), de tailles
+    quelconques. Renvoie un itérateur de bytes() dont la concaténation forme
+    le chiffré.
+    """
+    if not 0 < chunk_size <= TAILLE_MAX:
+        raise ValueError('chunk_size doit être compris entre 1 et {}'.format(TAILLE_MAX))
+    clefs = os.urandom(_CLEF_AES + _CLEF_MAC)
+    clef_aes, clef_mac = clefs[:_CLEF_AES], clefs[_CLEF_AES:]
+    iv = os.urandom(_IV)
+
+    enveloppe = _wrap_key(clefs, file_key)
+    entete = MAGIC + struct.pack('>H', len(enveloppe)) + enveloppe + iv + struct.pack('>I', chunk_size)
+    entete += hmac.new(clef_mac, entete, hashlib.sha256).digest()
+    yield entete
+    contexte = hashlib.sha256(entete).digest()
+
+    index = 0
+    for chiffre, dernier in _ctr_pipeline(clef_aes, iv, _rechunk(chunks, chunk_size)):
+        yield _record(clef_mac, contexte, index, chiffre, dernier)
+        index += 1
+    if index == 0:
+        # clair vide : il faut tout de même un morceau final, sinon le
+        # destinataire ne peut pas distinguer un chiffré vide d'un chiffré
+        # tronqué.
+        yield _record(clef_mac, contexte, 0, b'', True)
+
+
+def decrypt_stream(chunks, file_key_private, taille_max=TAILLE_MAX):
+    """
+    Déchiffre un flux produit par encrypt_stream() avec la clef privée (PEM)
+    contenue dans le fichier file_key_private. Renvoie un itérateur de
+    bytes() contenant le clair. Un chiffré dont les morceaux dépassent
+    taille_max octets est refusé.
+
+    Chaque morceau n'est déchiffré qu'après vérification de son HMAC. Si le
+    chiffré est modifié ou tronqué, IntegrityError est déclenchée ; les
+    morceaux déjà renvoyés à ce moment-là étaient authentiques.
+    """
+    lecteur = _Lecteur(chunks)
+    magic = lecteur.read(len(MAGIC))
+    if magic != MAGIC:
+        raise IntegrityError("ce n'est pas un chiffré hybride")
+    taille = lecteur.read_exactly(2)
+    (taille,) = struct.unpack('>H', taille)
+    enveloppe = lecteur.read_exactly(taille)
+    iv = lecteur.read_exactly(_IV)
+    champ_taille = lecteur.read_exactly(4)
+    entete = magic + struct.pack('>H', taille) + enveloppe + iv + champ_taille
+    tag = lecteur.read_exactly(_TAG)
+
+    clefs = _unwrap_key(enveloppe, file_key_private)
+    if len(clefs) != _CLEF_AES + _CLEF_MAC:
+        raise IntegrityError("enveloppe de clef invalide")
+    clef_aes, clef_mac = clefs[:_CLEF_AES], clefs[_CLEF_AES:]
+    if not hmac.compare_digest(tag, hmac.new(clef_mac, entete, hashlib.sha256).digest()):
+        raise IntegrityError("en-tête falsifié")
+    (taille_morceau,) = struct.unpack('>I', champ_taille)
+    if taille_morceau > taille_max:
+        raise IntegrityError("morceaux trop gros ({} octets, au plus {})".format(taille_morceau, taille_max))
+    entete += tag
+    contexte = hashlib.sha256(entete).digest()
+
+    records = _verified_records(lecteur, clef_mac, contexte, taille_morceau)
+    for clair, dernier in _ctr_pipeline(clef_aes, iv, records):
+        yield clair
+
+
+def encrypt_file(source, destination, file_key, chunk_size=CHUNK_SIZE):
+    """
+    Chiffre le fichier source dans le fichier destination (cf. encrypt_stream).
+    """
+    with open(source, 'rb') as entree, open(destination, 'wb') as sortie:
+        for bloc in encrypt_stream(_read_file(entree, chunk_size), file_key, chunk_size):
+            sortie.write(bloc)
+
+
+def decrypt_file(source, destination, file_key_private, chunk_size=CHUNK_SIZE, taille_max=TAILLE_MAX):
+    """
+    Déchiffre le fichier source dans le fichier destination (cf.
+    decrypt_stream). Le clair est d'abord écrit dans un fichier temporaire,
+    qui n'est renommé en destination que si tout le chiffré est authentique :
+    on ne laisse jamais de clair partiel ou falsifié derrière soi.
+    """
+    temporaire = destination + '.part'
+    try:
+        with open(source, 'rb') as entree, open(temporaire, 'wb') as sortie:
+            for bloc in decrypt_stream(_read_file(entree, chunk_size), file_key_private, taille_max):
+                sortie.write(bloc)
+        os.replace(temporaire, destination)
+    except BaseException:
+        if os.path.exists(temporaire):
+            os.remove(temporaire)
+        raise
+
+
+############################################################################
+#                          MÉTHODES INTERNES                               #
+############################################################################
+
+def _run_openssl(args, data):
+    result = subprocess.run(args, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # si un message d'erreur est présent sur stderr, on arrête tout
+    error_message = result.stderr.decode()
+    if result.returncode != 0 or error_message != '':
+        raise OpensslError(error_message)
+    return result.stdout
+
+
+def _wrap_key(clefs, file_key):
+    args = ['openssl', 'pkeyutl', '-encrypt', '-pubin', '-inkey', file_key,
+            '-pkeyopt', 'rsa_padding_mode:oaep']
+    return _run_openssl(args, clefs)
+
+
+def _unwrap_key(enveloppe, file_key_private):
+    args = ['openssl', 'pkeyutl', '-decrypt', '-inkey', file_key_private,
+            '-pkeyopt', 'rsa_padding_mode:oaep']
+    try:
+        return _run_openssl(args, enveloppe)
+    except OpensslError as e:
+        raise IntegrityError("impossible d'ouvrir l'enveloppe de clef : {}".format(e)) from None
+
+
+def _tag(clef_mac, contexte, index, entete, chiffre):
+    mac = hmac.new(clef_mac, contexte, hashlib.sha256)
+    mac.update(struct.pack('>Q', index))
+    mac.update(entete)
+    mac.update(chiffre)
+    return mac.digest()
+
+
+def _record(clef_mac, contexte, index, chiffre, dernier):
+    entete = struct.pack('>I', len(chiffre) | (_DERNIER if dernier else 0))
+    return entete + chiffre + _tag(clef_mac, contexte, index, entete, chiffre)
+
+
+def _verified_records(lecteur, clef_mac, contexte, taille_morceau):
+    """
+    Lit les morceaux du chiffré, vérifie leur HMAC et renvoie les chiffrés
+    authentiques. Déclenche IntegrityError si le flux s'arrête avant le
+    morceau final, si un morceau dépasse taille_morceau (avant même de le
+    lire) ou si des données traînent après.
+    """
+    index = 0
+    while True:
+        entete = lecteur.read(4)
+        if len(entete) < 4:
+            raise IntegrityError("chiffré tronqué")
+        (champ,) = struct.unpack('>I', entete)
+        dernier = bool(champ & _DERNIER)
+        longueur = champ & ~_DERNIER
+        if longueur > taille_morceau:
+            raise IntegrityError("morceau {} trop long".format(index))
+        chiffre = lecteur.read_exactly(longueur)
+        tag = lecteur.read_exactly(_TAG)
+        if not hmac.compare_digest(tag, _tag(clef_mac, contexte, index, entete, chiffre)):
+            raise IntegrityError("morceau {} falsifié".format(index))
+        if chiffre:
+            yield chiffre
+        if dernier:
+            break
+        index += 1
+    if lecteur.read(1):
+        raise IntegrityError("données en trop après le morceau final")
+
+
+def _ctr_pipeline(clef, iv, chunks):
+    """
+    Fait passer les morceaux dans un unique processus openssl en AES-256-CTR.
+    En mode CTR, la sortie a exactement la taille de l'entrée : on renvoie
+    donc, pour chaque morceau, le morceau transformé de même taille, et un
+    booléen qui indique si c'est le dernier.
+
+    Un thread alimente l'entrée standard d'openssl pendant qu'on lit sa
+    sortie, sinon les deux tuyaux pourraient se remplir et tout bloquer.
+    """
+    args = ['openssl', 'enc', '-aes-256-ctr', '-nosalt', '-K', clef.hex(), '-iv', iv.hex()]
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    tailles = queue.Queue()
+    erreurs = []
+    fini = object()
+
+    def alimente():
+        try:
+            for chunk in chunks:
+                # la taille est publiée avant l'écriture, pour que la lecture
+                # du morceau précédent puisse toujours savoir s'il est le
+                # dernier sans attendre que ce morceau-ci soit écrit.
+                tailles.put(len(chunk))
+                proc.stdin.write(chunk)
+        except BaseException as e:
+            erreurs.append(e)
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+            tailles.put(fini)
+
+    thread = threading.Thread(target=alimente, daemon=True)
+    thread.start()
+    try:
+        taille = tailles.get()
+        while taille is not fini:
+            sortie = proc.stdout.read(taille) if taille else b''
+            suivante = tailles.get()
+            if erreurs:
+                raise erreurs[0]
+            if len(sortie) != taille:
+                raise OpensslError(proc.stderr.read().decode())
+            yield sortie, suivante is fini
+            taille = suivante
+        if erreurs:
+            raise erreurs[0]
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        thread.join()
+        proc.wait()
+        proc.stderr.close()
+
+
+def _rechunk(chunks, chunk_size):
+    """Découpe les gros morceaux et ignore les morceaux vides."""
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        vue = memoryview(chunk)
+        for i in range(0, len(vue), chunk_size):
+            yield vue[i:i + chunk_size]
+
+
+def _read_file(f, chunk_size):
+    while True:
+        bloc = f.read(chunk_size)
+        if not bloc:
+            return
+        yield bloc
+
+
+class _Lecteur:
+    """
+    Présente un itérable de bytes() de tailles quelconques comme un fichier
+    dont on peut lire un nombre donné d'octets.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._tampon = bytearray()
+
+    def read(self, n):
+        while len(self._tampon) < n:
+            try:
+                self._tampon += next(self._chunks)
+            except StopIteration:
+                break
+        data = bytes(self._tampon[:n])
+        del self._tampon[:n]
+        return data
+
+    def read_exactly(self, n):
+        data = self.read(n)
+        if len(data) != n:
+            raise IntegrityError("chiffré tronqué")
+        return data
@@ -17,7 +17,8 @@ def encrypt(plaintext, passphrase, cipher='aes-128-cbc'):
        present on your system) to encrypt content using a symmetric cipher.
 
        The passphrase is an str object (a unicode string)
-       The plaintext is str() or bytes()
+       The plaintext is str(), bytes() or any bytes-like object (bytearray,
+       memoryview), which is sent to openssl without being copied
        The output is bytes()
 
        # encryption use
@@ -76,7 +77,11 @@ def decrypt(file_name, password, cipher='aes-128-cbc'):
     # On récupère des bytes, donc on en fait une chaine unicode
     return result.stdout.decode()
 
-def encrypt2(plaintext, passphrase, cipher='aes-128-cbc'):
+def encrypt2(plaintext, passphrase, cipher='aes-128-cbc', timeout=None):
+    # plaintext : str(), bytes() ou tout objet bytes-like (bytearray,
+    # memoryview), envoyé à openssl sans copie. Renvoie des bytes().
+    # timeout : durée maximale (en secondes) accordée à openssl ; au-delà, le
+    # processus est tué et subprocess.TimeoutExpired est déclenchée.
 
     # prépare les arguments à envoyer à openssl
     pass_arg = 'pass:{0}'.format(passphrase)
@@ -91,7 +96,8 @@ def encrypt2(plaintext, passphrase, cipher='aes-128-cbc'):
     # ouvre le pipeline vers openssl. envoie plaintext sur le stdin de openssl, récupère stdout et stderr
     #    affiche la commande invoquée
     #    print('debug : {0}'.format(' '.join(args)))
-    result = subprocess.run(args, input=plaintext, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    result = subprocess.run(args, input=plaintext, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            timeout=timeout)
 
     # si un message d'erreur est présent sur stderr, on arrête tout
     # attention, sur stderr on récupère des bytes(), donc on convertit
@@ -103,6 +109,35 @@ def encrypt2(plaintext, passphrase, cipher='aes-128-cbc'):
     # On récupère des bytes, donc on en fait une chaine unicode
     return result.stdout
 
+def decrypt2(ciphertext, passphrase, cipher='aes-128-cbc', timeout=None):
+    """déchiffre un chiffré binaire (tel que renvoyé par encrypt2() ou par la
+       passerelle), sans passer par le base64 ni par un fichier.
+
+       The ciphertext is bytes() or any bytes-like object (bytearray,
+       memoryview), sent to openssl without being copied.
+       The output is bytes() : the plaintext may be binary.
+
+       timeout (in seconds) bounds the openssl run : when it expires, the
+       process is killed and subprocess.TimeoutExpired is raised.
+    """
+    # prépare les arguments à envoyer à openssl
+    pass_arg = 'pass:{0}'.format(passphrase)
+    args = ['openssl', 'enc', '-d', '-' + cipher, '-pass', pass_arg, '-pbkdf2']
+
+    # ouvre le pipeline vers openssl. envoie le chiffré sur le stdin de openssl, récupère stdout et stderr
+    result = subprocess.run(args, input=ciphertext, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            timeout=timeout)
+
+    # si un message d'erreur est présent sur stderr, on arrête tout
+    # attention, sur stderr on récupère des bytes(), donc on convertit
+    error_message = result.stderr.decode()
+    if error_message != '':
+        raise OpensslError(error_message)
+
+    # on renvoie les bytes tels quels : pas de decode(), le clair peut être
+    # binaire
+    return result.stdout
+
 def lecture_message_erreur(reponse,K): 
     reponse = base64.b64encode(reponse).decode()
     print(reponse)
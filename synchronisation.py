@@ -0,0 +1,167 @@
+"""Envoi groupé d'un répertoire local vers /home.
+
+Dans banks_dh.ipynb, les fichiers de md5_collider étaient envoyés un par un,
+avec une cellule copiée-collée par fichier, et chaque nouvelle exécution
+renvoyait tout. synchroniser() envoie en parallèle tous les fichiers d'un
+répertoire, et tient à jour un manifeste local des empreintes SHA-256 de ce
+qui a déjà été envoyé : un fichier inchangé n'est pas renvoyé.
+
+    >>> c = connexion2('dh', login, password)
+    >>> c.synchroniser('md5_collider')
+    {'sent': 4, 'skipped': 0, 'bytes_sent': 512, 'bytes_skipped': 0, 'errors': {}}
+    >>> c.synchroniser('md5_collider')
+    {'sent': 0, 'skipped': 4, 'bytes_sent': 0, 'bytes_skipped': 512, 'errors': {}}
+
+Le manifeste est un fichier JSON (par défaut .uglix-manifeste.json, dans le
+répertoire envoyé), indexé par l'URL complète de destination : le même
+répertoire peut être synchronisé vers plusieurs comptes ou serveurs.
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+import concurrent.futures
+
+
+# nom du manifeste par défaut, à la racine du répertoire synchronisé
+MANIFESTE = '.uglix-manifeste.json'
+
+
+############################################################################
+#                          MÉTHODES PUBLIQUES                              #
+############################################################################
+
+class Manifeste:
+    """
+    Empreintes des fichiers déjà envoyés : destination -> {'sha256',
+    'taille', 'mtime_ns'}. La date de modification et la taille permettent
+    de ne recalculer l'empreinte que des fichiers qui ont été touchés.
+    Utilisable depuis plusieurs threads.
+    """
+    def __init__(self, chemin):
+        self.chemin = chemin
+        self._verrou = threading.Lock()
+        try:
+            with open(chemin) as f:
+                self._entrees = json.load(f)['fichiers']
+        except (OSError, ValueError, KeyError, TypeError):
+            # pas de manifeste (ou manifeste illisible) : tout sera envoyé
+            self._entrees = {}
+
+    def entree(self, destination):
+        with self._verrou:
+            return self._entrees.get(destination)
+
+    def noter(self, destination, empreinte, etat):
+        with self._verrou:
+            self._entrees[destination] = {'sha256': empreinte, 'taille': etat.st_size,
+                                          'mtime_ns': etat.st_mtime_ns}
+
+    def enregistrer(self):
+        """Écrit le manifeste sur disque (atomiquement)."""
+        with self._verrou:
+            donnees = {'version': 1, 'fichiers': self._entrees}
+            temporaire = '{}.{}.tmp'.format(self.chemin, os.getpid())
+            with open(temporaire, 'w') as f:
+                json.dump(donnees, f, indent=1, sort_keys=True)
+            os.replace(temporaire, self.chemin)
+
+
+def synchroniser(connexion, repertoire, destination, concurrence=4, manifeste=None, forcer=False):
+    """
+    Envoie (requêtes PUT) les fichiers de repertoire, sous-répertoires
+    compris, vers destination ('/home/<login>/'), avec concurrence envois
+    simultanés. Les fichiers dont l'empreinte SHA-256 n'a pas changé depuis
+    le dernier envoi réussi sont ignorés, sauf si forcer est vrai.
+
+    manifeste est le chemin du manifeste (par défaut, MANIFESTE dans
+    repertoire). Renvoie un bilan : nombre de fichiers envoyés et ignorés,
+    octets envoyés et ignorés, et erreurs (chemin relatif -> message).
+    """
+    if not os.path.isdir(repertoire):
+        raise NotADirectoryError("répertoire à synchroniser introuvable : {}".format(repertoire))
+    if not destination.endswith('/'):
+        destination += '/'
+    if manifeste is None:
+        manifeste = os.path.join(repertoire, MANIFESTE)
+    manifeste = Manifeste(manifeste)
+    ignores = {os.path.abspath(manifeste.chemin)}
+
+    bilan = collections.Counter(sent=0, skipped=0, bytes_sent=0, bytes_skipped=0)
+    erreurs = {}
+    verrou = threading.Lock()
+
+    def traiter(chemin, relatif):
+        url = destination + relatif
+        cle = connexion._base + url
+        try:
+            envoye, taille = _envoyer(connexion, manifeste, chemin, url, cle, forcer)
+        except Exception as e:
+            with verrou:
+                erreurs[relatif] = '{}: {}'.format(type(e).__name__, e)
+            return
+        with verrou:
+            if envoye:
+                bilan['sent'] += 1
+                bilan['bytes_sent'] += taille
+            else:
+                bilan['skipped'] += 1
+                bilan['bytes_skipped'] += taille
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(concurrence) as pool:
+            for chemin, relatif in _fichiers(repertoire):
+                if os.path.abspath(chemin) not in ignores:
+                    pool.submit(traiter, chemin, relatif)
+    except BaseException:
+        # on garde la trace des envois réussis, sans masquer l'erreur
+        # d'origine si le manifeste ne peut pas être écrit
+        try:
+            manifeste.enregistrer()
+        except OSError:
+            pass
+        raise
+    manifeste.enregistrer()
+    resultat = dict(bilan)
+    resultat['errors'] = erreurs
+    return resultat
+
+
+############################################################################
+#                          MÉTHODES INTERNES                               #
+############################################################################
+
+def _fichiers(repertoire):
+    """Énumère les fichiers de repertoire : (chemin, chemin relatif avec des '/')."""
+    for racine, sous_repertoires, noms in os.walk(repertoire):
+        sous_repertoires.sort()
+        for nom in sorted(noms):
+            if nom.endswith('.tmp') and nom.startswith(MANIFESTE):
+                continue
+            chemin = os.path.join(racine, nom)
+            yield chemin, os.path.relpath(chemin, repertoire).replace(os.sep, '/')
+
+
+def _envoyer(connexion, manifeste, chemin, url, cle, forcer):
+    """
+    Envoie un fichier s'il a changé. Renvoie (envoyé ?, taille).
+    """
+    etat = os.stat(chemin)
+    connu = manifeste.entree(cle)
+    if not forcer and connu is not None and connu['taille'] == etat.st_size \
+            and connu['mtime_ns'] == etat.st_mtime_ns:
+        # ni la taille ni la date n'ont changé : pas besoin de relire le fichier
+        return False, etat.st_size
+
+    # le contenu est lu une seule fois, pour l'empreinte et pour l'envoi
+    with open(chemin, 'rb') as f:
+        contenu = f.read()
+    empreinte = hashlib.sha256(contenu).hexdigest()
+    if not forcer and connu is not None and connu['sha256'] == empreinte:
+        # fichier touché mais identique : on met seulement la date à jour
+        manifeste.noter(cle, empreinte, etat)
+        return False, len(contenu)
+    connexion.put(url, contenu)
+    manifeste.noter(cle, empreinte, etat)
+    return True, len(contenu)
@@ -0,0 +1,291 @@
+"""Tests de client.py : décodage des réponses, et comportement de Connection
+face à un serveur HTTP local."""
+import collections
+import concurrent.futures
+import http.server
+import json
+import pickle
+import subprocess
+import threading
+import time
+import unittest
+import urllib.parse
+
+import client
+import controle
+
+
+class TestDecodageJSON(unittest.TestCase):
+
+    def test_grand_entier(self):
+        # les paramètres DH / RSA sont des entiers de plusieurs milliers de bits
+        n = 2 ** 2048 - 159
+        corps = '{{"p": {}, "g": 2, "B": {}}}'.format(n, -n).encode()
+        valeur = client.decoder_contenu(corps, 'application/json')
+        self.assertEqual(valeur, {'p': n, 'g': 2, 'B': -n})
+        self.assertIsInstance(valeur['p'], int)
+
+    def test_entier_juste_au_dela_de_64_bits(self):
+        for n in (2 ** 63, 2 ** 64, 2 ** 300, 10 ** 18, -2 ** 63 - 1):
+            self.assertEqual(client.decoder_contenu(str(n).encode(), 'application/json'), n)
+
+    def test_grand_entier_devine(self):
+        # réponses de la passerelle, sans type de contenu
+        n = 2 ** 300
+        corps = '{{"x": {}}}'.format(n).encode()
+        self.assertEqual(client.deviner_content_type(corps), 'application/json')
+
+    def test_detection_sans_double_decodage(self):
+        self.assertEqual(client._deviner(b'{"a": [1, 2]}'), ('application/json', {'a': [1, 2]}))
+        self.assertEqual(client._deviner('texte é'.encode()), ('text/plain; charset=utf-8', 'texte é'))
+        type_binaire, valeur = client._deviner(b'\x00\xff')
+        self.assertEqual(type_binaire, 'application/octet-stream')
+        self.assertIs(valeur, client._NON_DECODE)
+
+
+class _Gestionnaire(http.server.BaseHTTPRequestHandler):
+    """
+    /echo             répond immédiatement
+    /lent?d=0.3       répond au bout de d secondes
+    /binaire?d=0.3    contenu binaire (application/octet-stream)
+    /erreur           erreur 404, avec un corps JSON
+    /surcharge?n=1&ra=1
+                      429 avec Retry-After: ra pour les n premiers appels
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        serveur = self.server
+        chemin = urllib.parse.urlsplit(self.path)
+        parametres = dict(urllib.parse.parse_qsl(chemin.query))
+        with serveur.verrou:
+            serveur.requetes[chemin.path] += 1
+            numero = serveur.requetes[chemin.path]
+        if chemin.path in ('/lent', '/binaire'):
+            time.sleep(float(parametres.get('d', 0.3)))
+        if chemin.path == '/surcharge' and numero <= int(parametres.get('n', 1)):
+            return self.repondre(429, {'erreur': 'trop de requêtes'},
+                                 [('Retry-After', parametres.get('ra', '1'))])
+        if chemin.path == '/erreur':
+            return self.repondre(404, {'erreur': 'introuvable'})
+        if chemin.path == '/binaire':
+            return self.repondre_brut(200, bytes(range(256)), 'application/octet-stream')
+        self.repondre(200, {'chemin': chemin.path, 'numero': numero})
+
+    def repondre_brut(self, code, corps, content_type, entetes=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(corps)))
+        for nom, contenu in entetes:
+            self.send_header(nom, contenu)
+        self.end_headers()
+        self.wfile.write(corps)
+
+    def repondre(self, code, valeur, entetes=()):
+        self.repondre_brut(code, json.dumps(valeur).encode(), 'application/json', entetes)
+
+
+class TestServeurLocal(unittest.TestCase):
+    """Base des tests qui ont besoin d'un serveur HTTP local."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.serveur = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Gestionnaire)
+        cls.serveur.daemon_threads = True
+        cls.serveur.verrou = threading.Lock()
+        cls.serveur.requetes = collections.Counter()
+        cls.thread = threading.Thread(target=cls.serveur.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base = 'http://127.0.0.1:{}'.format(cls.serveur.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.serveur.shutdown()
+        cls.serveur.server_close()
+
+    def setUp(self):
+        with self.serveur.verrou:
+            self.serveur.requetes.clear()
+
+
+class TestErreurs(TestServeurLocal):
+
+    def test_post_process_voit_les_erreurs(self):
+        class Trace(client.Connection):
+            def _post_process(self, result, http_headers):
+                return ('vu', super()._post_process(result, http_headers))
+
+        with self.assertRaises(client.ServerError) as contexte:
+            Trace(self.base).get('/erreur')
+        self.assertEqual(contexte.exception.code, 404)
+        self.assertEqual(contexte.exception.msg, ('vu', {'erreur': 'introuvable'}))
+
+    def test_erreur_decodee_en_decodage_differe(self):
+        with self.assertRaises(client.ServerError) as contexte:
+            client.Connection(self.base, decodage_differe=True).get('/erreur')
+        self.assertEqual(contexte.exception.msg, {'erreur': 'introuvable'})
+
+
+def _en_parallele(fonctions):
+    """Lance les fonctions dans des threads ; renvoie résultats ou exceptions et durées."""
+    def executer(fonction):
+        debut = time.monotonic()
+        try:
+            resultat = fonction()
+        except Exception as e:
+            resultat = e
+        return resultat, time.monotonic() - debut
+
+    with concurrent.futures.ThreadPoolExecutor(len(fonctions)) as pool:
+        return list(pool.map(executer, fonctions))
+
+
+class TestRegroupement(TestServeurLocal):
+
+    def test_delai_de_lecture_partage(self):
+        # un délai de lecture écoulé est une erreur comme une autre : tous les
+        # appelants la reçoivent en même temps, sans renvoyer la requête
+        c = client.Connection(self.base, read_timeout=0.5, coalesce=True)
+        resultats = _en_parallele([lambda: c.get('/lent?d=2')] * 5)
+        for resultat, duree in resultats:
+            self.assertIsInstance(resultat, client.DeadlineExceeded)
+            self.assertLess(duree, 1.2)
+        self.assertEqual(self.serveur.requetes['/lent'], 1)
+        self.assertEqual(c.statistiques()['coalesced'], 4)
+
+    def test_echeance_du_meneur(self):
+        # le meneur manque sa propre échéance ; l'appelant sans échéance
+        # relance la requête et obtient le résultat
+        c = client.Connection(self.base, coalesce=True)
+
+        def meneur():
+            with c.delai(0.2):
+                return c.get('/lent?d=0.5')
+
+        def suiveur():
+            time.sleep(0.05)
+            return c.get('/lent?d=0.5')
+
+        (resultat_meneur, _), (resultat_suiveur, _) = _en_parallele([meneur, suiveur])
+        self.assertIsInstance(resultat_meneur, client.DeadlineExceeded)
+        self.assertEqual(resultat_suiveur['chemin'], '/lent')
+        self.assertEqual(c.statistiques().get('coalesced', 0), 0)
+
+    def test_resultat_memoryview(self):
+        precedent = client._CODECS.get('application/octet-stream')
+        client.enregistrer_codec('application/octet-stream', lambda corps, parametres: memoryview(corps))
+        try:
+            c = client.Connection(self.base, coalesce=True)
+            resultats = _en_parallele([lambda: c.get('/binaire?d=0.3')] * 4)
+        finally:
+            if precedent is None:
+                del client._CODECS['application/octet-stream']
+            else:
+                client._CODECS['application/octet-stream'] = precedent
+        for resultat, _ in resultats:
+            self.assertIsInstance(resultat, memoryview)
+            self.assertEqual(bytes(resultat), bytes(range(256)))
+        self.assertEqual(self.serveur.requetes['/binaire'], 1)
+
+    def test_copies_independantes(self):
+        c = client.Connection(self.base, coalesce=True)
+        resultats = _en_parallele([lambda: c.get('/lent?d=0.3')] * 3)
+        valeurs = [resultat for resultat, _ in resultats]
+        self.assertEqual(self.serveur.requetes['/lent'], 1)
+        valeurs[0]['chemin'] = 'modifié'
+        self.assertEqual([v['chemin'] for v in valeurs[1:]], ['/lent', '/lent'])
+
+
+class TestControleur(TestServeurLocal):
+
+    def test_retry_after_respecte(self):
+        ctrl = controle.ControleurDebit()
+        c = client.Connection(self.base, controleur=ctrl)
+        debut = time.monotonic()
+        self.assertEqual(c.get('/surcharge?n=1&ra=1')['numero'], 2)
+        # la seconde tentative attend la fin de la pause demandée
+        self.assertGreaterEqual(time.monotonic() - debut, 0.9)
+        self.assertEqual(self.serveur.requetes['/surcharge'], 2)
+        self.assertEqual(c.statistiques()['retries'], 1)
+        stats = ctrl.statistiques()
+        self.assertEqual((stats['throttled'], stats['ok']), (1, 1))
+        self.assertLess(stats['limite'], 4)
+
+    def test_tentatives_epuisees(self):
+        ctrl = controle.ControleurDebit()
+        c = client.Connection(self.base, controleur=ctrl, retries=2)
+        with self.assertRaises(client.ServerError) as contexte:
+            c.get('/surcharge?n=10&ra=0')
+        self.assertEqual(contexte.exception.code, 429)
+        self.assertEqual(self.serveur.requetes['/surcharge'], 3)
+        self.assertEqual(ctrl.statistiques()['throttled'], 3)
+
+    def test_pause_au_dela_de_l_echeance(self):
+        # la pause demandée dépasse l'échéance : on abandonne sans attendre
+        ctrl = controle.ControleurDebit()
+        c = client.Connection(self.base, controleur=ctrl)
+        debut = time.monotonic()
+        with self.assertRaises(client.DeadlineExceeded):
+            with c.delai(0.3):
+                c.get('/surcharge?n=1&ra=5')
+        self.assertLess(time.monotonic() - debut, 1)
+        self.assertEqual(self.serveur.requetes['/surcharge'], 1)
+        self.assertEqual(ctrl.statistiques()['en_pause'], ['/surcharge'])
+
+
+class TestEcheanceOpenssl(unittest.TestCase):
+
+    def test_processus_tue(self):
+        # _openssl() accorde au processus le temps restant avant l'échéance
+        def lent(*args, timeout=None):
+            return subprocess.run(['sleep', '5'], timeout=timeout)
+
+        c = client.Connection('http://127.0.0.1:9')
+        debut = time.monotonic()
+        with self.assertRaises(client.DeadlineExceeded):
+            with c.delai(0.3):
+                client.connexion2._openssl(c, lent)
+        self.assertLess(time.monotonic() - debut, 2)
+        self.assertEqual(c.statistiques()['deadline_exceeded'], 1)
+
+    def test_sans_echeance(self):
+        c = client.Connection('http://127.0.0.1:9')
+        chiffre = client.connexion2._openssl(c, client.encrypt2, 'clair', 'k')
+        self.assertEqual(client.connexion2._openssl(c, client.decrypt2, chiffre, 'k'), b'clair')
+
+
+def _get_echo(connexion, entree):
+    # exécutée dans un processus du pool de repartir()
+    return connexion.get('/echo')['chemin'], entree
+
+
+class TestRepartir(TestServeurLocal):
+
+    def test_apres_copies_et_regroupement(self):
+        c = client.Connection(self.base, hedge_percentile=0.5, coalesce=True)
+        # des latences variées, pour que des GET soient couverts par une copie
+        for i in range(client.Connection.HEDGE_MIN_SAMPLES + 10):
+            c.get('/lent?d={}'.format(0.3 if i % 4 == 0 else 0.01))
+        self.assertGreater(c.statistiques().get('hedges_sent', 0), 0)
+
+        with concurrent.futures.ThreadPoolExecutor(1) as attente:
+            futur = attente.submit(client.repartir, _get_echo, range(8), c, processes=2)
+            resultats = futur.result(timeout=30)
+        self.assertEqual(resultats, [('/echo', i) for i in range(8)])
+        # la connexion d'origine fonctionne toujours
+        self.assertEqual(c.get('/echo')['chemin'], '/echo')
+
+    def test_poignee(self):
+        c = client.Connection(self.base, coalesce=True, read_timeout=5)
+        c.get('/echo')
+        copie = pickle.loads(pickle.dumps(c))
+        self.assertEqual(copie._read_timeout, 5)
+        self.assertEqual(copie.statistiques(), {})
+        self.assertEqual(copie.get('/echo')['chemin'], '/echo')
+
+
+if __name__ == '__main__':
+    unittest.main()
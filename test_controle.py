@@ -0,0 +1,62 @@
+"""Tests de controle.py : lecture de Retry-After et réaction aux 429/503."""
+import email.utils
+import time
+import unittest
+
+import controle
+
+
+class TestRetryAfter(unittest.TestCase):
+
+    def test_secondes(self):
+        self.assertEqual(controle.lire_retry_after('3'), 3.0)
+        self.assertEqual(controle.lire_retry_after(' 0 '), 0.0)
+
+    def test_date(self):
+        date = email.utils.formatdate(time.time() + 30, usegmt=True)
+        self.assertAlmostEqual(controle.lire_retry_after(date), 30, delta=2)
+        # une date passée ne donne pas de pause négative
+        date = email.utils.formatdate(time.time() - 30, usegmt=True)
+        self.assertEqual(controle.lire_retry_after(date), 0.0)
+
+    def test_absent_ou_illisible(self):
+        for valeur in (None, '', 'bientôt', '-1'):
+            self.assertIsNone(controle.lire_retry_after(valeur))
+
+
+class TestSurcharge(unittest.TestCase):
+
+    def test_pause_et_reduction(self):
+        ctrl = controle.ControleurDebit(limite_initiale=8)
+        jeton = ctrl.acquerir('/bin/police_hq/ticket/1496')
+        ctrl.liberer(jeton, 429, 0.01, retry_after=0.3)
+        stats = ctrl.statistiques()
+        self.assertEqual(stats['limite'], 4)
+        self.assertEqual(stats['en_pause'], ['/bin/police_hq/ticket/*'])
+        # le point d'accès est en pause, les autres non
+        self.assertIsNone(ctrl.acquerir('/bin/police_hq/ticket/1497', timeout=0.1))
+        ctrl.liberer(ctrl.acquerir('/bin/echo', timeout=0.1), 200)
+        debut = time.monotonic()
+        ctrl.liberer(ctrl.acquerir('/bin/police_hq/ticket/1497', timeout=1), 200)
+        self.assertGreaterEqual(time.monotonic() - debut, 0.1)
+
+    def test_pause_par_defaut(self):
+        ctrl = controle.ControleurDebit(pause_defaut=0.2)
+        ctrl.liberer(ctrl.acquerir('/bin/echo'), 503)
+        self.assertEqual(ctrl.statistiques()['en_pause'], ['/bin/echo'])
+        self.assertIsNone(ctrl.acquerir('/bin/echo', timeout=0.05))
+        self.assertIsNotNone(ctrl.acquerir('/bin/echo', timeout=1))
+
+    def test_une_reduction_par_salve(self):
+        # des requêtes parties ensemble et refusées ensemble ne divisent la
+        # limite qu'une fois
+        ctrl = controle.ControleurDebit(limite_initiale=8)
+        jetons = [ctrl.acquerir('/bin/echo') for _ in range(4)]
+        for jeton in jetons:
+            ctrl.liberer(jeton, 429, retry_after=0)
+        self.assertEqual(ctrl.statistiques()['limite'], 4)
+        self.assertEqual(ctrl.statistiques()['throttled'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
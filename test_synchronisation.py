@@ -0,0 +1,67 @@
+"""Tests de synchronisation.py, avec une fausse connexion qui garde les PUT."""
+import os
+import tempfile
+import threading
+import unittest
+
+import synchronisation
+
+
+class _FausseConnexion:
+    _base = 'http://uglix.test'
+
+    def __init__(self):
+        self.fichiers = {}
+        self._verrou = threading.Lock()
+
+    def put(self, url, contenu):
+        with self._verrou:
+            self.fichiers[url] = bytes(contenu)
+
+
+class TestSynchroniser(unittest.TestCase):
+
+    def setUp(self):
+        self.repertoire = tempfile.TemporaryDirectory()
+        self.racine = self.repertoire.name
+        os.mkdir(os.path.join(self.racine, 'sous'))
+        self.ecrire('AC', b'\x00\x01' * 64)
+        self.ecrire('sous/BD', b'collision')
+        self.c = _FausseConnexion()
+
+    def tearDown(self):
+        self.repertoire.cleanup()
+
+    def ecrire(self, nom, contenu):
+        with open(os.path.join(self.racine, nom), 'wb') as f:
+            f.write(contenu)
+
+    def test_envoi_puis_rien_a_faire(self):
+        bilan = synchronisation.synchroniser(self.c, self.racine, '/home/bob')
+        self.assertEqual(bilan, {'sent': 2, 'skipped': 0, 'bytes_sent': 137, 'bytes_skipped': 0, 'errors': {}})
+        self.assertEqual(self.c.fichiers['/home/bob/sous/BD'], b'collision')
+        self.assertNotIn('/home/bob/' + synchronisation.MANIFESTE, self.c.fichiers)
+
+        self.c.fichiers.clear()
+        bilan = synchronisation.synchroniser(self.c, self.racine, '/home/bob/')
+        self.assertEqual((bilan['sent'], bilan['skipped'], bilan['bytes_skipped']), (0, 2, 137))
+        self.assertEqual(self.c.fichiers, {})
+
+    def test_seul_le_fichier_modifie_est_renvoye(self):
+        synchronisation.synchroniser(self.c, self.racine, '/home/bob/')
+        self.ecrire('sous/BD', b'collision 2')
+        os.utime(os.path.join(self.racine, 'AC'))      # touché, mais identique
+        self.c.fichiers.clear()
+        bilan = synchronisation.synchroniser(self.c, self.racine, '/home/bob/')
+        self.assertEqual((bilan['sent'], bilan['skipped']), (1, 1))
+        self.assertEqual(list(self.c.fichiers), ['/home/bob/sous/BD'])
+
+    def test_repertoire_introuvable(self):
+        absent = os.path.join(self.racine, 'absent')
+        with self.assertRaises(NotADirectoryError) as contexte:
+            synchronisation.synchroniser(self.c, absent, '/home/bob/')
+        self.assertIn('absent', str(contexte.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+"""Tests de verification.py : les résultats doivent être ceux d'openssl."""
+import base64
+import os
+import subprocess
+import tempfile
+import unittest
+
+import verification
+from verification import VALIDE, INVALIDE, ERREUR
+
+
+def openssl(*args, entree=None):
+    return subprocess.run(('openssl',) + args, input=entree, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, check=True).stdout
+
+
+class TestVerificationLot(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.repertoire = tempfile.TemporaryDirectory()
+        cls.cles = {}
+        generation = {
+            'secp256k1': ('ecparam', '-name', 'secp256k1', '-genkey', '-noout'),
+            'prime256v1': ('ecparam', '-name', 'prime256v1', '-genkey', '-noout'),
+            'rsa': ('genpkey', '-algorithm', 'RSA', '-pkeyopt', 'rsa_keygen_bits:2048'),
+        }
+        for nom, args in generation.items():
+            privee = os.path.join(cls.repertoire.name, nom + '.pem')
+            openssl(*args, '-out', privee)
+            publique = openssl('pkey', '-in', privee, '-pubout').decode()
+            cls.cles[nom] = (privee, publique)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.repertoire.cleanup()
+
+    def signer(self, nom, message):
+        return openssl('dgst', '-sha256', '-sign', self.cles[nom][0], entree=message.encode())
+
+    def verifier_openssl(self, nom, signature, message):
+        """Statut donné par openssl dgst -verify (la référence)."""
+        fichier_cle = os.path.join(self.repertoire.name, nom + '.pub')
+        with open(fichier_cle, 'w') as f:
+            f.write(self.cles[nom][1])
+        fichier_signature = os.path.join(self.repertoire.name, 'signature')
+        with open(fichier_signature, 'wb') as f:
+            f.write(signature)
+        result = subprocess.run(['openssl', 'dgst', '-sha256', '-verify', fichier_cle,
+                                 '-signature', fichier_signature],
+                                input=message.encode(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return VALIDE if result.returncode == 0 else INVALIDE
+
+    def comparer(self, cas):
+        """cas : liste de (nom de clef, signature brute, message)."""
+        triplets = [(self.cles[nom][1], base64.b64encode(sig).decode(), message) for nom, sig, message in cas]
+        resultats = verification.verification_signatures_lot(triplets, processes=1)
+        for (nom, sig, message), resultat in zip(cas, resultats):
+            self.assertEqual(resultat.statut, self.verifier_openssl(nom, sig, message), (nom, sig.hex()))
+        return [r.statut for r in resultats]
+
+    def test_signatures_valides_et_modifiees(self):
+        cas = []
+        for nom in self.cles:
+            for i in range(5):
+                message = '{},{},UGLIX'.format(nom, i)
+                signature = self.signer(nom, message)
+                cas.append((nom, signature, message))
+                cas.append((nom, signature, message + 'x'))
+                falsifiee = bytearray(signature)
+                falsifiee[len(falsifiee) // 2] ^= 1
+                cas.append((nom, bytes(falsifiee), message))
+        statuts = self.comparer(cas)
+        self.assertEqual(statuts[0::3], [VALIDE] * 15)
+
+    def test_ecdsa_non_der(self):
+        cas = []
+        for nom in ('secp256k1', 'prime256v1'):
+            message = 'challenge ' + nom
+            signature = self.signer(nom, message)
+            tag, contenu, _ = verification._der(signature, 0)
+            # SEQUENCE avec une longueur en forme longue
+            cas.append((nom, b'\x30\x81' + bytes([len(contenu)]) + contenu, message))
+            # premier INTEGER précédé d'un zéro inutile
+            (_, r), (_, s) = verification._der_sequence(contenu)
+            r_long = b'\x02' + bytes([len(r) + 1]) + b'\x00' + r
+            s_der = b'\x02' + bytes([len(s)]) + s
+            cas.append((nom, b'\x30' + bytes([len(r_long) + len(s_der)]) + r_long + s_der, message))
+        self.assertEqual(self.comparer(cas), [INVALIDE] * 4)
+
+    def test_ecdsa_octets_en_trop(self):
+        # pas de comparaison avec openssl dgst ici : il ne lit que les
+        # premiers octets du fichier de signature (autant que la taille
+        # maximale d'une signature), et ignore donc parfois ceux en trop
+        for nom in ('secp256k1', 'prime256v1'):
+            message = 'challenge ' + nom
+            signature = base64.b64encode(self.signer(nom, message) + b'\x00').decode()
+            resultat, = verification.verification_signatures_lot([(self.cles[nom][1], signature, message)], processes=1)
+            self.assertEqual(resultat.statut, INVALIDE)
+
+    def test_rsa_longueur(self):
+        message = 'challenge rsa'
+        signature = self.signer('rsa', message)
+        self.assertEqual(self.comparer([('rsa', b'\x00' + signature, message),
+                                        ('rsa', signature[1:], message)]), [INVALIDE] * 2)
+
+    def test_clef_malformee(self):
+        # AlgorithmIdentifier vide : une erreur pour cet élément seulement
+        der = bytes.fromhex('300730000303000102')
+        pem = '-----BEGIN PUBLIC KEY-----\n{}\n-----END PUBLIC KEY-----\n'.format(base64.b64encode(der).decode())
+        message = 'challenge'
+        signature = base64.b64encode(self.signer('secp256k1', message)).decode()
+        resultats = verification.verification_signatures_lot(
+            [(pem, signature, message), (self.cles['secp256k1'][1], signature, message)], processes=1)
+        self.assertEqual([r.statut for r in resultats], [ERREUR, VALIDE])
+
+
+if __name__ == '__main__':
+    unittest.main()
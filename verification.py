@@ -0,0 +1,452 @@
+"""Vérification de signatures par lots.
+
+verification_signature_carte() (cf. openssl.py) vérifie un seul triplet
+(clef, signature, challenge) par appel : elle écrit deux fichiers, lance
+openssl, et devine le résultat en cherchant 'Failure' dans sa sortie.
+Pour auditer des milliers de signatures de cartes ou de banques, on utilise
+plutôt verification_signatures_lot() :
+
+    >>> res = verification_signatures_lot([(pk, signature, S), ...])
+    >>> [r.statut for r in res]
+    ['valid', 'invalid', ...]
+
+Chaque clef publique distincte n'est décodée qu'une seule fois. Les
+signatures ECDSA (secp256k1, prime256v1) et RSA PKCS#1 v1.5 avec SHA-256
+sont vérifiées directement en Python, sans lancer openssl ; les autres
+types de clef passent par openssl dgst. Le travail est réparti sur un pool
+de processus, par paquets de signatures qui partagent la même clef.
+"""
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import os
+import subprocess
+import tempfile
+
+
+# résultat de la vérification d'une signature : statut vaut VALIDE, INVALIDE
+# ou ERREUR (clef illisible, signature mal encodée en base64, openssl en
+# panne...). message contient les explications en cas d'erreur.
+VALIDE = 'valid'
+INVALIDE = 'invalid'
+ERREUR = 'error'
+ResultatVerification = collections.namedtuple('ResultatVerification', ['statut', 'message'])
+
+
+############################################################################
+#                          MÉTHODES PUBLIQUES                              #
+############################################################################
+
+def verification_signatures_lot(triplets, processes=None, chunksize=64):
+    """
+    Vérifie un lot de signatures SHA-256. triplets est un itérable de
+    triplets (clef publique PEM, signature en base64, challenge), comme les
+    arguments de verification_signature_carte(). Renvoie la liste des
+    ResultatVerification, dans l'ordre des triplets.
+
+    Une signature fausse ou une clef illisible ne déclenche pas d'exception :
+    elle donne un résultat INVALIDE ou ERREUR pour l'élément concerné.
+
+    processes est le nombre de processus du pool (par défaut, le nombre de
+    processeurs) ; chunksize est le nombre maximal de signatures envoyées
+    d'un coup à un processus.
+    """
+    # regroupe les signatures par clef, pour ne décoder chaque clef qu'une
+    # fois et pour que chaque processus réutilise ses précalculs
+    groupes = collections.OrderedDict()
+    nombre = 0
+    for index, (key_certificat, signature, challenge) in enumerate(triplets):
+        groupes.setdefault(key_certificat, []).append((index, signature, challenge))
+        nombre = index + 1
+    if nombre == 0:
+        return []
+
+    resultats = [None] * nombre
+    with tempfile.TemporaryDirectory() as repertoire:
+        paquets = []
+        for key_certificat, elements in groupes.items():
+            cle = lire_cle_publique(key_certificat, repertoire)
+            for i in range(0, len(elements), chunksize):
+                paquets.append((cle, elements[i:i + chunksize]))
+
+        if len(paquets) == 1 or processes == 1:
+            lots = map(_verifier_paquet, paquets)
+            for lot in lots:
+                for index, resultat in lot:
+                    resultats[index] = resultat
+        else:
+            with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+                for lot in pool.map(_verifier_paquet, paquets):
+                    for index, resultat in lot:
+                        resultats[index] = resultat
+    return resultats
+
+
+def lire_cle_publique(key_certificat, repertoire=None):
+    """
+    Décode une clef publique au format PEM (telle que renvoyée par
+    recuperer_cle_public()). Renvoie un tuple :
+        ('rsa', n, e)
+        ('ec', nom de la courbe, x, y)
+        ('openssl', fichier)        type de clef non géré en Python : la clef
+                                    est écrite dans un fichier de repertoire
+        ('erreur', message)         clef illisible
+    """
+    if isinstance(key_certificat, bytes):
+        key_certificat = key_certificat.decode('utf-8', 'replace')
+    try:
+        der = _pem_vers_der(key_certificat)
+        cle = _decoder_spki(der)
+    except (ValueError, IndexError) as e:
+        # IndexError : SEQUENCE DER plus courte que prévu
+        return ('erreur', 'clef publique illisible : {}'.format(e))
+    if cle is not None:
+        return cle
+    if repertoire is None:
+        return ('erreur', 'type de clef publique non géré')
+    # on laisse openssl se débrouiller avec les autres types de clefs
+    nom = os.path.join(repertoire, hashlib.sha256(der).hexdigest() + '.der')
+    with open(nom, 'wb') as f:
+        f.write(der)
+    return ('openssl', nom)
+
+
+############################################################################
+#                          MÉTHODES INTERNES                               #
+############################################################################
+
+def _verifier_paquet(paquet):
+    """
+    Vérifie des signatures qui partagent la même clef (exécuté dans un
+    processus du pool). Renvoie une liste de couples (index, résultat).
+    """
+    cle, elements = paquet
+    if cle[0] == 'erreur':
+        return [(index, ResultatVerification(ERREUR, cle[1])) for index, _, _ in elements]
+
+    if cle[0] == 'ec':
+        verifier = _VerificateurECDSA(cle[1], cle[2], cle[3]).verifier
+    elif cle[0] == 'rsa':
+        verifier = _VerificateurRSA(cle[1], cle[2]).verifier
+    else:
+        verifier = _VerificateurOpenssl(cle[1]).verifier
+
+    resultats = []
+    for index, signature, challenge in elements:
+        try:
+            signature = base64.b64decode(signature, validate=True)
+        except (ValueError, TypeError) as e:
+            resultats.append((index, ResultatVerification(ERREUR, 'signature mal encodée : {}'.format(e))))
+            continue
+        if isinstance(challenge, str):
+            challenge = challenge.encode('utf-8')
+        try:
+            ok = verifier(signature, challenge)
+        except OSError as e:
+            resultats.append((index, ResultatVerification(ERREUR, str(e))))
+            continue
+        if ok is None:
+            resultats.append((index, ResultatVerification(ERREUR, 'openssl ne sait pas vérifier cette signature')))
+        else:
+            resultats.append((index, ResultatVerification(VALIDE if ok else INVALIDE, None)))
+    return resultats
+
+
+#################################################
+##########        DER / PEM         #############
+#################################################
+
+_OID_RSA = bytes.fromhex('2a864886f70d010101')
+_OID_EC = bytes.fromhex('2a8648ce3d0201')
+
+
+def _pem_vers_der(pem):
+    lignes = [l.strip() for l in pem.strip().splitlines()]
+    if not lignes or lignes[0] != '-----BEGIN PUBLIC KEY-----' or lignes[-1] != '-----END PUBLIC KEY-----':
+        raise ValueError('ce n\'est pas une clef publique PEM')
+    return base64.b64decode(''.join(lignes[1:-1]), validate=True)
+
+
+def _der(data, pos):
+    """Lit un élément DER à la position pos : renvoie (tag, contenu, position suivante)."""
+    if pos + 2 > len(data):
+        raise ValueError('DER tronqué')
+    tag = data[pos]
+    longueur = data[pos + 1]
+    pos += 2
+    if longueur & 0x80:
+        n = longueur & 0x7f
+        longueur = int.from_bytes(data[pos:pos + n], 'big')
+        pos += n
+    if pos + longueur > len(data):
+        raise ValueError('DER tronqué')
+    return tag, data[pos:pos + longueur], pos + longueur
+
+
+def _der_entier(valeur):
+    """Encode un entier positif en DER (INTEGER, encodage minimal)."""
+    contenu = valeur.to_bytes(valeur.bit_length() // 8 + 1, 'big')
+    return b'\x02' + _der_longueur(len(contenu)) + contenu
+
+
+def _der_longueur(longueur):
+    if longueur < 0x80:
+        return bytes([longueur])
+    octets = longueur.to_bytes((longueur.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(octets)]) + octets
+
+
+def _der_sequence(data):
+    """Découpe le contenu d'une SEQUENCE DER en liste de (tag, contenu)."""
+    elements = []
+    pos = 0
+    while pos < len(data):
+        tag, contenu, pos = _der(data, pos)
+        elements.append((tag, contenu))
+    return elements
+
+
+def _decoder_spki(der):
+    """
+    Décode un SubjectPublicKeyInfo. Renvoie None si le type de clef n'est pas
+    géré en Python.
+    """
+    tag, spki, _ = _der(der, 0)
+    algorithme, cle = _der_sequence(spki)
+    algorithme = _der_sequence(algorithme[1])
+    oid = algorithme[0][1]
+    if cle[0] != 0x03 or not cle[1] or cle[1][0] != 0:
+        raise ValueError('BIT STRING invalide')
+    cle = cle[1][1:]
+
+    if oid == _OID_RSA:
+        _, rsa, _ = _der(cle, 0)
+        (_, n), (_, e) = _der_sequence(rsa)
+        return ('rsa', int.from_bytes(n, 'big'), int.from_bytes(e, 'big'))
+
+    if oid == _OID_EC and len(algorithme) > 1:
+        nom = _OID_COURBES.get(algorithme[1][1])
+        if nom is None:
+            return None
+        courbe = _COURBES[nom]
+        x, y = courbe.decoder_point(cle)
+        return ('ec', nom, x, y)
+    return None
+
+
+#################################################
+##########          ECDSA           #############
+#################################################
+
+class _Courbe:
+    """Courbe elliptique y^2 = x^3 + ax + b sur F_p, de générateur G d'ordre n."""
+    def __init__(self, p, a, b, gx, gy, n):
+        self.p = p
+        self.a = a
+        self.b = b
+        self.g = (gx, gy)
+        self.n = n
+        self._table_g = None
+
+    def decoder_point(self, data):
+        p = self.p
+        taille = (p.bit_length() + 7) // 8
+        if len(data) == 1 + 2 * taille and data[0] == 4:
+            x = int.from_bytes(data[1:1 + taille], 'big')
+            y = int.from_bytes(data[1 + taille:], 'big')
+        elif len(data) == 1 + taille and data[0] in (2, 3):
+            x = int.from_bytes(data[1:], 'big')
+            # p = 3 mod 4 pour les courbes gérées : la racine carrée est facile
+            y = pow((x * x * x + self.a * x + self.b) % p, (p + 1) // 4, p)
+            if (y & 1) != (data[0] & 1):
+                y = p - y
+        else:
+            raise ValueError('point de courbe mal encodé')
+        if x >= p or y >= p or (y * y - x * x * x - self.a * x - self.b) % p != 0:
+            raise ValueError('le point n\'est pas sur la courbe')
+        return x, y
+
+    # les points sont en coordonnées jacobiennes (X, Y, Z), qui évitent une
+    # inversion modulaire par addition ; None est le point à l'infini.
+
+    def doubler(self, P):
+        if P is None:
+            return None
+        X, Y, Z = P
+        p = self.p
+        if Y == 0:
+            return None
+        YY = Y * Y % p
+        S = 4 * X * YY % p
+        M = (3 * X * X + self.a * pow(Z, 4, p)) % p
+        X3 = (M * M - 2 * S) % p
+        Y3 = (M * (S - X3) - 8 * YY * YY) % p
+        Z3 = 2 * Y * Z % p
+        return (X3, Y3, Z3)
+
+    def ajouter(self, P, Q):
+        if P is None:
+            return Q
+        if Q is None:
+            return P
+        X1, Y1, Z1 = P
+        X2, Y2, Z2 = Q
+        p = self.p
+        Z1Z1 = Z1 * Z1 % p
+        Z2Z2 = Z2 * Z2 % p
+        U1 = X1 * Z2Z2 % p
+        U2 = X2 * Z1Z1 % p
+        S1 = Y1 * Z2 * Z2Z2 % p
+        S2 = Y2 * Z1 * Z1Z1 % p
+        if U1 == U2:
+            if S1 != S2:
+                return None
+            return self.doubler(P)
+        H = (U2 - U1) % p
+        R = (S2 - S1) % p
+        HH = H * H % p
+        HHH = H * HH % p
+        V = U1 * HH % p
+        X3 = (R * R - HHH - 2 * V) % p
+        Y3 = (R * (V - X3) - S1 * HHH) % p
+        Z3 = H * Z1 * Z2 % p
+        return (X3, Y3, Z3)
+
+    def table(self, x, y):
+        """Précalcule [0, P, 2P, ..., 15P] pour la multiplication par fenêtres de 4 bits."""
+        P = (x, y, 1)
+        table = [None, P]
+        for _ in range(14):
+            table.append(self.ajouter(table[-1], P))
+        return table
+
+    def table_g(self):
+        if self._table_g is None:
+            self._table_g = self.table(*self.g)
+        return self._table_g
+
+    def double_multiplication(self, u1, table1, u2, table2):
+        """Calcule u1*P1 + u2*P2 en partageant les doublements (astuce de Shamir)."""
+        R = None
+        for decalage in range(((self.n.bit_length() + 3) // 4 - 1) * 4, -1, -4):
+            for _ in range(4):
+                R = self.doubler(R)
+            R = self.ajouter(R, table1[(u1 >> decalage) & 15])
+            R = self.ajouter(R, table2[(u2 >> decalage) & 15])
+        return R
+
+
+_COURBES = {
+    'secp256k1': _Courbe(
+        p=0xfffffffffffffffffffffffffffffffffffffffffffffffffffffffefffffc2f,
+        a=0,
+        b=7,
+        gx=0x79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798,
+        gy=0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8,
+        n=0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141),
+    'prime256v1': _Courbe(
+        p=0xffffffff00000001000000000000000000000000ffffffffffffffffffffffff,
+        a=0xffffffff00000001000000000000000000000000fffffffffffffffffffffffc,
+        b=0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b,
+        gx=0x6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296,
+        gy=0x4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb6406837bf51f5,
+        n=0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551),
+}
+_OID_COURBES = {
+    bytes.fromhex('2b8104000a'): 'secp256k1',
+    bytes.fromhex('2a8648ce3d030107'): 'prime256v1',
+}
+
+
+class _VerificateurECDSA:
+    def __init__(self, nom, x, y):
+        self.courbe = _COURBES[nom]
+        # précalcul propre à la clef, amorti sur toutes ses signatures
+        self.table_q = self.courbe.table(x, y)
+
+    def verifier(self, signature, challenge):
+        courbe = self.courbe
+        n = courbe.n
+        try:
+            tag, contenu, fin = _der(signature, 0)
+            (tag_r, r), (tag_s, s) = _der_sequence(contenu)
+        except ValueError:
+            return False
+        if tag != 0x30 or fin != len(signature) or tag_r != 2 or tag_s != 2:
+            return False
+        r = int.from_bytes(r, 'big')
+        s = int.from_bytes(s, 'big')
+        if not (0 < r < n and 0 < s < n):
+            return False
+        # comme openssl, on refuse tout encodage autre que le DER canonique
+        # (longueurs en forme longue, entiers non minimaux ou négatifs...)
+        contenu = _der_entier(r) + _der_entier(s)
+        if signature != b'\x30' + _der_longueur(len(contenu)) + contenu:
+            return False
+
+        z = int.from_bytes(hashlib.sha256(challenge).digest(), 'big')
+        if n.bit_length() < 256:
+            z >>= 256 - n.bit_length()
+        w = pow(s, -1, n)
+        R = courbe.double_multiplication(z * w % n, courbe.table_g(), r * w % n, self.table_q)
+        if R is None:
+            return False
+        X, _, Z = R
+        x = X * pow(Z * Z, -1, courbe.p) % courbe.p
+        return x % n == r
+
+
+#################################################
+##########     RSA PKCS#1 v1.5      #############
+#################################################
+
+# DigestInfo DER d'un haché SHA-256, sans le haché lui-même
+_PREFIXE_SHA256 = bytes.fromhex('3031300d060960864801650304020105000420')
+
+
+class _VerificateurRSA:
+    def __init__(self, n, e):
+        self.n = n
+        self.e = e
+        self.k = (n.bit_length() + 7) // 8
+
+    def verifier(self, signature, challenge):
+        if len(signature) != self.k:
+            return False
+        s = int.from_bytes(signature, 'big')
+        if s >= self.n:
+            return False
+        em = pow(s, self.e, self.n).to_bytes(self.k, 'big')
+        t = _PREFIXE_SHA256 + hashlib.sha256(challenge).digest()
+        attendu = b'\x00\x01' + b'\xff' * (self.k - len(t) - 3) + b'\x00' + t
+        return em == attendu
+
+
+#################################################
+##########         openssl          #############
+#################################################
+
+class _VerificateurOpenssl:
+    """Pour les types de clef non gérés en Python, on se rabat sur openssl dgst."""
+    def __init__(self, fichier_cle):
+        self.fichier_cle = fichier_cle
+
+    def verifier(self, signature, challenge):
+        fd, fichier_signature = tempfile.mkstemp(dir=os.path.dirname(self.fichier_cle), suffix='.sig')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(signature)
+            args = ['openssl', 'dgst', '-sha256', '-keyform', 'DER', '-verify', self.fichier_cle,
+                    '-signature', fichier_signature]
+            result = subprocess.run(args, input=challenge, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        finally:
+            os.remove(fichier_signature)
+        # on se fie au code de retour plutôt qu'à la sortie : 0 si la
+        # signature est bonne, 1 si elle est fausse ou mal formée.
+        if result.returncode == 0:
+            return True
+        sortie = result.stdout.decode() + result.stderr.decode()
+        if 'Verification failure' in sortie or 'Error verifying data' in sortie:
+            return False
+        return None